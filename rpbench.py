@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+
+# Benchmark for rproxy
+# Copyright 2014-2020 William McBrine
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+""" Benchmark for rproxy
+
+    Runs rproxy against a simulated TiVo (tivosim.py), all on the
+    loopback interface, and drives it with a number of clients at once.
+    Each client sends SETCH commands, one at a time, each for a channel
+    of its own, and waits for the matching CH_STATUS before sending the
+    next. Every client also receives every other client's status
+    messages.
+
+    Reports the command throughput; the end-to-end latency of each
+    command (from sending it, to receiving its status); the fan-out
+    latency (from the simulator sending a status message, to each
+    client receiving it); and rproxy's peak and final resident memory.
+
+    With --churn, instead checks for leaks: many clients connect and
+    disconnect, in batches, while rproxy's open files, threads and
+    memory are compared before and after, and its count of connected
+    clients (via --metrics, on the third port) is checked at the end.
+    The exit status is 1 if any didn't return to (about) where they
+    started.
+
+    Command-line options:
+
+    -c, --clients      The number of clients. The default is 10.
+
+    -n, --commands     The number of commands each client sends. The
+                       default is 20.
+
+    -l, --latency      How long the simulated TiVo takes over each
+                       command, in seconds. The default is 0.
+
+    -t, --timeout      How long to wait for any one status response
+                       before giving up on the command, in seconds. The
+                       default is 10.
+
+    -p, --port         The first of two ports to use, for the simulator
+                       and rproxy (three with --churn). The default is
+                       41339.
+
+    -C, --churn        Connect and disconnect this many clients in all,
+                       -c at a time; in each batch, one changes the
+                       channel, and the others just disconnect.
+
+    -j, --json         Print the results as JSON, for comparing runs.
+
+    -h, --help         Print help and exit.
+
+    Any other options are passed to rproxy, e.g. "--pacing=adaptive" or
+    "-e asyncio". Put them after "--" to keep them from being read as
+    benchmark options.
+
+"""
+
+__author__ = 'William McBrine <wmcbrine@gmail.com>'
+__version__ = '0.8'
+__license__ = 'GPL'
+
+import getopt
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from tivosim import TiVoSim
+
+RPROXY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'rproxy.py')
+
+class BenchClient:
+    """ One remote control client, run in its own thread. Each status
+        message received is logged with its time of arrival.
+
+    """
+    def __init__(self, port, first, count, timeout):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.settimeout(timeout)
+        self.channels = range(first, first + count)
+        self.received = []
+        self.latencies = []
+        self.lost = 0
+        self.finished = False
+        self.buf = b''
+
+    def run(self, done):
+        for channel in self.channels:
+            status = ('CH_STATUS %04d LOCAL' % channel).encode('ascii')
+            start = time.time()
+            self.sock.sendall(('SETCH %d\r' % channel).encode('ascii'))
+            if self.wait_for(status):
+                self.latencies.append(time.time() - start)
+            else:
+                self.lost += 1
+        self.finished = True
+        self.sock.settimeout(0.5)
+        while not done.is_set():
+            self.wait_for(None)
+
+    def wait_for(self, status):
+        """ Read until the given status arrives. Return False on timeout
+            or disconnection.
+
+        """
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except socket.timeout:
+                return False
+            if not data:
+                return False
+            now = time.time()
+            lines = (self.buf + data).split(b'\r')
+            self.buf = lines.pop()
+            found = False
+            for line in lines:
+                self.received.append((now, line + b'\r'))
+                if line == status:
+                    found = True
+            if found:
+                return True
+
+def rss(pid):
+    """ Return the resident memory of a process, in KB, or None. """
+    try:
+        for line in open('/proc/%d/status' % pid):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    try:
+        return int(subprocess.check_output(['ps', '-o', 'rss=', '-p',
+                                            str(pid)]))
+    except Exception:
+        return None
+
+def usage(pid):
+    """ Return the open files, threads and resident memory (in KB) of a
+        process. Each is None if it can't be found.
+
+    """
+    result = {'fds': None, 'threads': None, 'rss_kb': rss(pid)}
+    try:
+        result['fds'] = len(os.listdir('/proc/%d/fd' % pid))
+        for line in open('/proc/%d/status' % pid):
+            if line.startswith('Threads:'):
+                result['threads'] = int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return result
+
+def connected(port):
+    """ Return the number of clients rproxy has connected, per its
+        metrics, or None if that can't be found.
+
+    """
+    try:
+        sock = socket.create_connection(('127.0.0.1', port), 5)
+        sock.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+        data = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        sock.close()
+    except socket.error:
+        return None
+    count = None
+    for line in data.decode('ascii', 'replace').split('\n'):
+        if line.startswith('rproxy_clients{'):
+            count = (count or 0) + int(line.split()[-1])
+    return count
+
+def percentiles(values):
+    """ Return the 50th, 90th and 99th percentiles, and the maximum, in
+        milliseconds.
+
+    """
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {}
+    for name, pct in (('p50', 50), ('p90', 90), ('p99', 99)):
+        index = min(len(values) - 1, len(values) * pct // 100)
+        result[name] = round(values[index] * 1000, 3)
+    result['max'] = round(values[-1] * 1000, 3)
+    return result
+
+def wait_for_port(port, proc, timeout=10):
+    limit = time.time() + timeout
+    while time.time() < limit and proc.poll() is None:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+    return False
+
+def launch(port, latency, args, status=0):
+    """ Start the simulator and rproxy, and return them. """
+    sim = TiVoSim(('127.0.0.1', port), latency, status)
+    sim.start()
+
+    proxy = subprocess.Popen([sys.executable, RPROXY, '-z', '-p',
+                              str(port + 1)] + args +
+                             ['127.0.0.1:%d' % port])
+    if not wait_for_port(port + 1, proxy):
+        proxy.kill()
+        sys.stderr.write('rproxy failed to start\n')
+        sys.exit(1)
+    return sim, proxy
+
+def bench(clients, commands, latency, timeout, port, args):
+    sim, proxy = launch(port, latency, args)
+
+    peak = [rss(proxy.pid)]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            peak[0] = max(peak[0] or 0, rss(proxy.pid) or 0) or None
+            time.sleep(0.1)
+
+    group = [BenchClient(port + 1, 1000 + i * commands, commands, timeout)
+             for i in range(clients)]
+    time.sleep(0.2)  # let rproxy see them all
+    threads = [threading.Thread(target=c.run, args=(done,)) for c in group]
+    threads.append(threading.Thread(target=sample))
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    while not all(c.finished for c in group):
+        time.sleep(0.05)
+    elapsed = time.time() - start
+    time.sleep(0.5)  # let the last status messages fan out
+    done.set()
+    for thread in threads:
+        thread.join()
+    final = rss(proxy.pid)
+    proxy.terminate()
+    proxy.wait()
+
+    latencies = []
+    fanout = []
+    lost = 0
+    for c in group:
+        latencies.extend(c.latencies)
+        lost += c.lost
+        for when, status in c.received:
+            # Skip the replayed status from before the clients' commands
+            sent = sim.sent.get(status)
+            if sent and sent >= start:
+                fanout.append(when - sent)
+        c.sock.close()
+
+    done_count = len(latencies)
+    return {'clients': clients, 'commands': clients * commands,
+            'completed': done_count, 'lost': lost,
+            'seconds': round(elapsed, 3),
+            'throughput': round(done_count / elapsed, 2),
+            'latency_ms': percentiles(latencies),
+            'fanout_ms': percentiles(fanout),
+            'rss_kb': {'peak': peak[0], 'final': final}}
+
+def churn_batch(port, clients, channel, timeout):
+    """ Connect a batch of clients; have one change the channel, and wait
+        for the status; then disconnect them all. Return False if the
+        status never came.
+
+    """
+    group = [BenchClient(port, channel, 1, timeout) for i in range(clients)]
+    lead = group[0]
+    lead.sock.sendall(('SETCH %d\r' % channel).encode('ascii'))
+    found = lead.wait_for(('CH_STATUS %04d LOCAL' % channel).encode('ascii'))
+    for c in group:
+        c.sock.close()
+    return found
+
+def churn(total, clients, latency, timeout, port, args):
+    args = args + ['--metrics=127.0.0.1:%d' % (port + 2)]
+    sim, proxy = launch(port, latency, args)
+    batches = max(1, total // clients)
+
+    # Warm up, so that one-time allocations don't count as growth
+    for i in range(2):
+        churn_batch(port + 1, clients, 1000 + i, timeout)
+    time.sleep(1)
+    before = usage(proxy.pid)
+
+    lost = 0
+    start_time = time.time()
+    for i in range(batches):
+        if not churn_batch(port + 1, clients, 1002 + i, timeout):
+            lost += 1
+    elapsed = time.time() - start_time
+
+    # Give the client threads time to finish
+    limit = time.time() + 10
+    while True:
+        after = usage(proxy.pid)
+        if (time.time() > limit or (after['fds'] or 0) <= (before['fds'] or 0)
+            and (after['threads'] or 0) <= (before['threads'] or 0)):
+            break
+        time.sleep(0.2)
+    after['clients'] = connected(port + 2)
+    proxy.terminate()
+    proxy.wait()
+
+    flat = True
+    for key in ('fds', 'threads'):
+        if before[key] is not None and after[key] > before[key]:
+            flat = False
+    if before['rss_kb'] and after['rss_kb'] > before['rss_kb'] * 1.1:
+        flat = False
+    if after['clients']:
+        flat = False
+    return {'connections': batches * clients, 'lost': lost,
+            'seconds': round(elapsed, 3), 'before': before, 'after': after,
+            'flat': flat}
+
+def report_churn(results):
+    print('%(connections)d connections in %(seconds).3f seconds '
+          '(%(lost)d status messages lost)' % results)
+    for key, title in (('fds', 'Open files'), ('threads', 'Threads'),
+                       ('rss_kb', 'RSS (KB)')):
+        print('%s: %s before, %s after' % (title, results['before'][key],
+                                           results['after'][key]))
+    print('Clients still registered: %s' % results['after']['clients'])
+    print(results['flat'] and 'OK' or 'LEAK')
+
+def report(results):
+    print('%(completed)d of %(commands)d commands from %(clients)d clients '
+          'in %(seconds).3f seconds (%(lost)d lost)' % results)
+    print('Throughput: %.2f commands/second' % results['throughput'])
+    for title, key in (('Latency', 'latency_ms'), ('Fan-out', 'fanout_ms')):
+        pct = results[key]
+        if pct:
+            print('%s (ms): p50 %.3f, p90 %.3f, p99 %.3f, max %.3f' %
+                  (title, pct['p50'], pct['p90'], pct['p99'], pct['max']))
+    print('rproxy RSS (KB): peak %s, final %s' %
+          (results['rss_kb']['peak'], results['rss_kb']['final']))
+
+def parse_cmdline(params):
+    settings = {'clients': 10, 'commands': 20, 'latency': 0,
+                'timeout': 10, 'port': 41339, 'churn': 0}
+    as_json = False
+
+    try:
+        opts, args = getopt.gnu_getopt(params, 'c:n:l:t:p:C:jh', ['clients=',
+                                       'commands=', 'latency=', 'timeout=',
+                                       'port=', 'churn=', 'json', 'help'])
+    except getopt.GetoptError as msg:
+        sys.stderr.write('%s\n' % str(msg))
+        sys.exit(1)
+
+    for opt, value in opts:
+        if opt in ('-c', '--clients'):
+            settings['clients'] = int(value)
+        elif opt in ('-n', '--commands'):
+            settings['commands'] = int(value)
+        elif opt in ('-l', '--latency'):
+            settings['latency'] = float(value)
+        elif opt in ('-t', '--timeout'):
+            settings['timeout'] = float(value)
+        elif opt in ('-p', '--port'):
+            settings['port'] = int(value)
+        elif opt in ('-C', '--churn'):
+            settings['churn'] = int(value)
+        elif opt in ('-j', '--json'):
+            as_json = True
+        elif opt in ('-h', '--help'):
+            print(__doc__)
+            sys.exit()
+
+    settings['args'] = args
+    return settings, as_json
+
+def main(argv):
+    settings, as_json = parse_cmdline(argv)
+    total = settings.pop('churn')
+    if total:
+        del settings['commands']
+        results = churn(total, **settings)
+    else:
+        results = bench(**settings)
+    if as_json:
+        print(json.dumps(results, sort_keys=True))
+    elif total:
+        report_churn(results)
+    else:
+        report(results)
+    if total and not results['flat']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-# Remote Proxy for TiVo, v0.7
+# Remote Proxy for TiVo, v0.8
 # Copyright 2014-2020 William McBrine
 #
 # This program is free software; you can redistribute it and/or
@@ -34,7 +34,17 @@
     -p, --port         Specify the port to serve from. The default is
                        31339, the standard TiVo "Crestron" remote port.
                        (If not specified, and 31339 is already in use,
-                       the next nine ports will also be tried.)
+                       the next nine ports will also be tried.) With more
+                       than one TiVo, each gets the next port.
+
+    -u, --unix         Also serve clients on a Unix domain socket at this
+                       path, for clients on the same machine. With more
+                       than one TiVo, each gets the path plus '.1', '.2',
+                       etc.
+
+    --notcp            Serve clients only on the Unix socket, not on a
+                       TCP port. (TiVos can still be found via Zeroconf,
+                       but the proxy isn't announced.)
 
     -l, --list         List TiVos found on the network, and exit.
 
@@ -43,74 +53,401 @@
     -f, --first        Scan the network and connect to the first available
                        TiVo. Ignores proxies.
 
+    -A, --all          Scan the network and proxy every TiVo found, each
+                       on its own port. Ignores proxies.
+
+    -c, --config       Read the TiVos to proxy from a file, one per line:
+                       the name, TSN or address (as for <address>),
+                       optionally followed by the port to serve it on.
+                       Lines starting with '#' are ignored.
+
     -z, --nozeroconf   Disable Zeroconf announcements.
 
+    --quiet-period     When looking for TiVos on the network (as for -l,
+                       -i or -A), stop after this many seconds without
+                       a new one answering. The default is 1. TiVos
+                       wanted by name or TSN end the search as soon as
+                       they're all found.
+
+    --cache            Remember the TiVos found on the network in this
+                       file, so that those wanted by name or TSN can be
+                       connected to at once next time, while the network
+                       is checked in the background. The default is
+                       '~/.rproxy-cache.json'.
+
+    --cache-ttl        How long to trust a TiVo's entry in the cache,
+                       after it was last seen, in seconds. The default
+                       is 86400 (a day); 0 disables the cache.
+
     -v, --verbose      Echo messages to and from the TiVo to the console.
+                       (Same as --log-level=debug.)
                        (In combination with -l, show extended details.)
 
+    --log-level        How much to report on the console: 'error' (the
+                       default) for failures only; 'info' for
+                       connections, disconnections and dropped commands
+                       too; or 'debug' for everything, as with -v.
+
+    --log-json         Write each console message as a JSON object, with
+                       its time and level.
+
+    --log-rate         Log at most this many messages per second, not
+                       counting errors; the rest are dropped, and the
+                       number dropped is logged. The default is no limit.
+
     -x, --exitdc       Exit on disconnection from the TiVo (e.g. it reboots). 
                        Absent this option, rproxy will attempt to reconnect.
 
+    --backoff          The longest wait between attempts to reconnect, in
+                       seconds. The wait starts short, and doubles after
+                       each failure, up to this limit. The default is 5.
+
+    --hold             How long to hold commands while reconnecting, in
+                       seconds. If the TiVo isn't back by then, they're
+                       dropped, and the client that sent each one gets a
+                       COMMAND_DROPPED message. The default is 10.
+
+    --max-age          How long a command may wait to be sent, in seconds,
+                       by kind, as a comma-separated list; '*' covers the
+                       rest, e.g. 'IRCODE:2,*:5'. Older commands are
+                       dropped, and the client that sent them gets a
+                       COMMAND_EXPIRED message. The default is 5 seconds
+                       for IRCODE, and 10 for the rest.
+
+    -e, --engine       Select how connections are handled: 'thread' (the
+                       default) uses a thread per client; 'asyncio' runs
+                       everything from a single thread, which scales to
+                       thousands of clients. (Requires Python 3.)
+
+    --pacing           'fixed' (the default) waits a tenth of a second
+                       after each command; 'adaptive' waits according to
+                       the kind of command, and sends the next as soon as
+                       the TiVo responds to the last (e.g. with CH_STATUS).
+
+    --pace             Set the longest wait after each kind of command in
+                       adaptive mode, in seconds, as a comma-separated
+                       list, e.g. 'IRCODE:0.05,SETCH:0.2'.
+
+    --queue-depth      The most commands to hold for any one client; more
+                       are dropped. The default is 100.
+
+    --priority         Give clients on some hosts more turns in the queue,
+                       as a comma-separated list of host:turns, e.g.
+                       '192.168.1.20:4'. Clients take turns sending
+                       commands; by default, each gets one per turn.
+
+    --coalesce         Merge commands in the queue: a channel change
+                       (SETCH or FORCECH) or TELEPORT replaces any of the
+                       same kind still waiting, and a keypress (IRCODE or
+                       KEYBOARD) identical to one from another client
+                       within this many seconds is dropped. Off by default.
+
+    --output-limit     The most status messages to hold for a client that
+                       isn't keeping up. The default is 64.
+
+    --overflow         What to do when a client has more status messages
+                       waiting than that: 'oldest' (the default) drops the
+                       oldest, 'latest' keeps only the newest, and 'drop'
+                       disconnects the client.
+
+    --batch            Gather status messages from the TiVo for this many
+                       seconds after the first, and send them to each
+                       client together, with fewer system calls and
+                       packets. The default is 0 (send each at once).
+
+    --keepalive        Detect connections (to the TiVo or clients) that
+                       have silently died -- e.g. by a power cut --
+                       within about twice this many seconds, with TCP
+                       keepalives and TCP_USER_TIMEOUT. The default is
+                       10; 0 disables it.
+
+    --nagle            Leave Nagle's algorithm on, letting the system
+                       hold back small writes to combine them. By
+                       default, each command and status message is sent
+                       at once (TCP_NODELAY).
+
+    --probe            When the link to the TiVo has been idle for this
+                       many seconds, send it a blank line (which the
+                       TiVo ignores), so that a dead connection shows up
+                       as a failed write, and reconnection begins. The
+                       default is 0 (never).
+
+    --idle             Disconnect clients that send no commands for this
+                       many seconds. The default is 0 (never). Clients
+                       whose output has been stuck for a minute are
+                       disconnected regardless.
+
+    --max-clients      The most clients to serve at once (per TiVo). The
+                       default is 0 (no limit).
+
+    --accept-policy    What to do with a new client when there are
+                       already that many: 'refuse' (the default) turns it
+                       away, 'oldest' drops the longest connected client
+                       to make room, and 'idle' drops the one that has
+                       gone longest without sending a command.
+
+    --metrics          Serve metrics (queue depth, commands sent, latency
+                       histograms, clients, bytes in and out, reconnects,
+                       etc.) over HTTP on this port (or address:port), in
+                       the Prometheus text format.
+
+    --trace            Record the progress of each command through the
+                       proxy -- when it was received, taken from the
+                       queue, sent to the TiVo, and answered with a
+                       status message -- in this file ('-' for the
+                       console), one JSON object per line.
+
+    --trace-rate       The fraction of commands to trace, e.g. 0.01 for
+                       one in a hundred. The default is 1 (all).
+
     -h, --help         Print help and exit.
 
     <address>          Any other command-line option is treated as the name,
                        TiVo Service Number, or IP address (with optional
                        port number) of the TiVo to connect to. This is a
-                       required parameter, except with -l, -i, -f or -h.
+                       required parameter, except with -l, -i, -f, -A, -c
+                       or -h. Several may be given, to proxy several TiVos
+                       from the same process.
 
 """
 
 __author__ = 'William McBrine <wmcbrine@gmail.com>'
-__version__ = '0.7'
+__version__ = '0.8'
 __license__ = 'GPL'
 
+import collections
+import errno
 import getopt
+import itertools
+import json
+import os
+import random
 import select
 import socket
+import stat
 import sys
+import threading
 import time
 
 if 3 == sys.version_info[0]:
     import _thread
-    from queue import Queue
     inp = input
 else:
     import thread as _thread
-    from Queue import Queue
     inp = raw_input
 
-have_zc = True
 try:
-    import zeroconf
+    import asyncio
 except:
-    have_zc = False
+    asyncio = None
+
+zeroconf = None   # Imported when needed; see load_zeroconf()
 
 DEFAULT_HOST = ('', 31339)
 SERVICE = '_tivo-remote._tcp.local.'
 
+# Longest partial command to hold while waiting for its terminator
+
+MAX_COMMAND = 1024
+
+# Most bytes to take from a socket at once
+
+RECV_SIZE = 4096
+
+# Most commands to hold for any one client
+
+QUEUE_DEPTH = 100
+
+# Status messages to hold for a client whose connection is backed up,
+# and what to do when there are more: drop the oldest, keep only the
+# latest, or drop the client
+
+OUTPUT_LIMIT = 64
+OVERFLOW = ('oldest', 'latest', 'drop')
+
+# What to do with a new client when --max-clients are connected: turn it
+# away, or make room by dropping the oldest or the longest idle client
+
+ACCEPT_POLICIES = ('refuse', 'oldest', 'idle')
+
+# Seconds a client's output may stay backed up without any of it being
+# taken, before the client is presumed gone; and how often to check
+
+STALL = 60
+REAP_INTERVAL = 5
+
+# Pending connections to allow, so that a burst of clients (e.g. all
+# reconnecting at once) isn't held up by dropped SYNs
+
+BACKLOG = 128
+
+# Seconds of silence on a connection before TCP keepalive probes begin,
+# and how many unanswered probes mean it's dead (see tune_socket())
+
+KEEPALIVE = 10
+KEEPALIVE_PROBES = 3
+
+# Bytes an asyncio transport may buffer before the outbox takes over
+
+WRITE_BUFFER = 4096
+
+# Most buffers to hand to one sendmsg() call, and whether it's available
+# (scatter/gather output, without joining the messages first)
+
+IOV_MAX = 64
+SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# Send without blocking, where the platform allows it
+
+DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+# Status messages kept (the latest of each kind) for new clients
+
+CACHED_STATUS = (b'CH_STATUS', b'LIVETV_READY')
+
+# Coalescing: commands where only the latest of each group matters, and
+# keypresses that may be merged when sent from different clients at once
+
+LATEST_WINS = {b'SETCH': b'channel', b'FORCECH': b'channel',
+               b'TELEPORT': b'teleport'}
+KEYPRESSES = (b'IRCODE', b'KEYBOARD')
+
+# Pacing: the fixed gap between commands, and in adaptive mode, the
+# longest gap after each kind of command (the ceiling), the status
+# responses that end the wait early, and the shortest gap regardless.
+
+PACE_FIXED = 0.1
+PACE_FLOOR = 0.02
+PACE_CEILINGS = {b'IRCODE': 0.05, b'KEYBOARD': 0.03, b'SETCH': 0.1,
+                 b'FORCECH': 0.1, b'TELEPORT': 0.1}
+PACE_ACKS = {b'IRCODE': (b'CH_STATUS', b'LIVETV_READY'),
+             b'SETCH': (b'CH_STATUS', b'CH_FAILED'),
+             b'FORCECH': (b'CH_STATUS', b'CH_FAILED'),
+             b'TELEPORT': (b'CH_STATUS', b'LIVETV_READY',
+                           b'MISSING_TELEPORT_NAME')}
+
+# How long a command may wait to be sent, by kind ('*' for the rest),
+# before it's dropped, and the notice sent back when it is
+
+MAX_AGES = {b'IRCODE': 5, b'*': 10}
+EXPIRED = b'COMMAND_EXPIRED '
+
+# Reconnection: the first and longest waits between attempts, how long
+# to hold commands while the TiVo is away, and the notice sent back for
+# each one dropped when that time is up
+
+BACKOFF_MIN = 0.25
+BACKOFF_MAX = 5
+HOLD = 10
+DROPPED = b'COMMAND_DROPPED '
+
+# Histogram buckets for the metrics, in seconds, and the command classes
+# labelled by name (any others are counted as 'other')
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1, 2.5, 5, 10)
+COMMAND_CLASSES = (b'IRCODE', b'KEYBOARD', b'SETCH', b'FORCECH', b'TELEPORT')
+
+# Log levels, in order, and the most log records to hold for the writer
+# before dropping them
+
+LOG_LEVELS = ('error', 'info', 'debug')
+LOG_DEPTH = 1000
+
+# Discovery: how long to wait for more TiVos after the last one answers
+# (unless those wanted are already found), and the longest to wait at all
+
+QUIET_PERIOD = 1
+DISCOVERY_MAX = 10
+
+# Where to remember the TiVos found, and for how long (in seconds)
+
+CACHE_FILE = '~/.rproxy-cache.json'
+CACHE_TTL = 24 * 60 * 60
+
+# How often to look up the TiVo again while a proxy can't reach it
+
+TRACK_INTERVAL = 5
+
 # Target modes
 
 _TFIRST = 1
 _TLIST = 2
 _TSELECT = 3
+_TALL = 4
+
+def load_zeroconf():
+    """ Import the zeroconf module, which is needed only to find TiVos and
+        announce the proxies, on first use. Return True if available.
+
+    """
+    global zeroconf
+    if zeroconf is None:
+        try:
+            import zeroconf
+        except:
+            zeroconf = False
+    return bool(zeroconf)
 
 class ZCListener:
-    def __init__(self, names):
-        self.names = names
+    """ Resolve each TiVo as the ServiceBrowser finds it, each in its own
+        thread, collecting the records in self.tivos (and passing each to
+        found(), if set). Changes are signalled through self.cond. The
+        names of TiVos that say goodbye are passed to lost(), if set.
+
+    """
+    def __init__(self, rz, found=None, lost=None):
+        self.rz = rz
+        self.found = found
+        self.lost = lost
+        self.names = []
+        self.tivos = {}
+        self.pending = set()
+        self.last = time.time()
+        self.cond = threading.Condition()
 
     def removeService(self, server, type, name):
-        self.names.remove(name)
+        with self.cond:
+            if name in self.names:
+                self.names.remove(name)
+        if self.lost:
+            self.lost(name)
 
     def addService(self, server, type, name):
-        self.names.append(name)
+        with self.cond:
+            self.names.append(name)
+            self.pending.add(name)
+            self.last = time.time()
+        _thread.start_new_thread(self.resolve, (name,))
+
+    def resolve(self, name):
+        """ Get the address and properties -- this is the slow part. """
+        try:
+            s = self.rz.getServiceInfo(SERVICE, name)
+        except:
+            s = None
+        with self.cond:
+            self.pending.discard(name)
+            self.last = time.time()
+            if s:
+                address = (socket.inet_ntoa(s.getAddress()), s.getPort())
+                data = (name.replace('.' + SERVICE, ''), s.getProperties())
+                self.tivos[address] = data
+                if self.found:
+                    self.found(address, data)
+            self.cond.notify_all()
 
 class ZCBroadcast:
     def __init__(self):
         self.rz = zeroconf.Zeroconf()
-        self.info = None
+        self.registrations = []
+        self.stopped = threading.Event()
 
     def announce(self, target, addr, tivos):
-        """ Announce the availability of our service. """
+        """ Announce the availability of our service. This continues in
+            the background; return the Registration.
+
+        """
         host, port = addr
         host_ip = self.get_address(host)
         if target in tivos:
@@ -122,57 +459,107 @@ class ZCBroadcast:
                     'platform': 'tcd/Series3'}
         name = 'Proxy(%s)' % name
 
-        self.info = zeroconf.ServiceInfo(SERVICE, '%s.%s' % (name, SERVICE),
-                                         host_ip, port, 0, 0, prop)
-        self.rz.registerService(self.info)
+        info = zeroconf.ServiceInfo(SERVICE, '%s.%s' % (name, SERVICE),
+                                    host_ip, port, 0, 0, prop)
+        registration = self.rz.registerServiceAsync(info)
+        self.registrations.append(registration)
+        return registration
 
-    def find_tivos(self, all=False):
-        """ Get the records of TiVos offering remote control. """
-        tivos = {}
-        tivo_names = []
+    def find_tivos(self, all=False, done=None, found=None,
+                   quiet=QUIET_PERIOD):
+        """ Get the records of TiVos offering remote control. Each is
+            resolved as soon as it answers, and passed to found(), if set.
+            Return as soon as done(tivos) is true, if set (and no proxies
+            that might supersede a TiVo are still being looked up);
+            otherwise, once nothing new has turned up for 'quiet' seconds.
 
+        """
+        listener = ZCListener(self.rz, found)
         try:
-            browser = zeroconf.ServiceBrowser(self.rz, SERVICE,
-                                              ZCListener(tivo_names))
+            browser = zeroconf.ServiceBrowser(self.rz, SERVICE, listener)
         except:
-            return tivos
+            return {}
+
+        start = time.time()
+        with listener.cond:
+            while True:
+                tivos = self.unproxied(listener, all)
+                now = time.time()
+                proxies = [t for t in listener.pending
+                           if t.startswith('Proxy(')]
+                if done and not proxies and done(tivos):
+                    break
+                if now - start >= DISCOVERY_MAX:
+                    break
+                wait = listener.last + quiet - now
+                if wait <= 0 and not listener.pending:
+                    break
+                listener.cond.wait(max(wait, 0.1))
+            listener.found = None
+        browser.cancel()
+        return tivos
 
-        time.sleep(1)    # Give them a second to respond
-
-        if not all:
-            # For proxied TiVos, remove the original
-            for t in tivo_names[:]:
-                if t.startswith('Proxy('):
-                    try:
-                        t = t.replace('.' + SERVICE, '')[6:-1] + '.' + SERVICE
-                        tivo_names.remove(t)
-                    except:
-                        pass
-
-        # Now get the addresses and properties -- this is the slow part
-        for t in tivo_names:
-            s = self.rz.getServiceInfo(SERVICE, t)
-            if s:
-                name = t.replace('.' + SERVICE, '')
-                address = socket.inet_ntoa(s.getAddress())
-                port = s.getPort()
-                prop = s.getProperties()
-                tivos[(address, port)] = (name, prop)
+    def unproxied(self, listener, all=False):
+        """ Return the TiVos found so far -- unless 'all' is set, without
+            those that are already proxied (by name or by address).
 
+        """
+        tivos = dict(listener.tivos)
         if not all:
-            # For proxies with numeric names, remove the original
-            for t in tivo_names:
-                if t.startswith('Proxy('):
-                    address = t.replace('.' + SERVICE, '')[6:-1]
-                    for key in list(tivos.keys()):
-                        if key[0] == address:
-                            tivos.pop(key)
+            proxied = [t.replace('.' + SERVICE, '')[6:-1]
+                       for t in listener.names if t.startswith('Proxy(')]
+            for key, data in list(tivos.items()):
+                if data[0] in proxied or key[0] in proxied:
+                    tivos.pop(key)
         return tivos
 
+    def track(self, proxies, tivos):
+        """ Keep browsing, and follow each proxy's TiVo (as listed in
+            'tivos'), by its TSN, to any new address -- as soon as it's
+            announced, or, while the proxy can't connect, by looking it
+            up again every TRACK_INTERVAL seconds. Run until shutdown().
+
+        """
+        tracked = {}
+        for proxy in proxies:
+            name, prop = tivos.get(proxy.target, ('', None))
+            if prop and prop.get('TSN') and not name.startswith('Proxy('):
+                tracked[prop['TSN']] = (name + '.' + SERVICE, proxy)
+        if not tracked:
+            return
+
+        def found(address, data):
+            name, prop = data
+            if prop and not name.startswith('Proxy('):
+                name, proxy = tracked.get(prop.get('TSN'), (None, None))
+                if proxy:
+                    proxy.retarget(address)
+
+        def lost(name):
+            for t_name, proxy in tracked.values():
+                if name == t_name:
+                    proxy.log.info('TiVo at %s, port %d said goodbye',
+                                   *proxy.target)
+
+        listener = ZCListener(self.rz, found, lost)
+        try:
+            browser = zeroconf.ServiceBrowser(self.rz, SERVICE, listener)
+        except:
+            return
+        while not self.stopped.is_set():
+            self.stopped.wait(TRACK_INTERVAL)
+            for name, proxy in tracked.values():
+                if not (proxy.tivo or proxy.closed or
+                        self.stopped.is_set()):
+                    listener.resolve(name)
+        browser.cancel()
+
     def shutdown(self):
         """ Out of service. """
-        if self.info:
-            self.rz.unregisterService(self.info)
+        self.stopped.set()
+        for registration in self.registrations:
+            if registration.wait(0):
+                self.rz.unregisterService(registration.info)
         self.rz.close()
 
     def get_address(self, host):
@@ -182,166 +569,2003 @@ class ZCBroadcast:
             host = s.getsockname()[0]
         return socket.inet_aton(host)
 
+class Cache:
+    """ The TiVos found on the network, kept in a JSON file between runs,
+        each for 'ttl' seconds after it was last seen, so that TiVos
+        wanted by name or TSN can be connected to at once. Proxies are
+        left out. Failures to read or write the file are ignored.
+
+    """
+    def __init__(self, filename=CACHE_FILE, ttl=CACHE_TTL):
+        self.filename = os.path.expanduser(filename)
+        self.ttl = ttl
+
+    def entries(self):
+        """ Return the unexpired entries in the file, as dicts. """
+        now = time.time()
+        try:
+            with open(self.filename) as f:
+                entries = json.load(f)['tivos']
+            return [e for e in entries if e['expires'] > now]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return []
+
+    def load(self):
+        """ Return the cached TiVos, in the form of find_tivos(). """
+        return dict(((e['address'], e['port']), (e['name'],
+                                                 e['properties']))
+                    for e in self.entries())
+
+    def save(self, tivos):
+        """ Add (or refresh) TiVos, replacing any older entries with the
+            same name or address.
+
+        """
+        expires = time.time() + self.ttl
+        fresh = [{'address': address, 'port': port, 'name': name,
+                  'properties': prop, 'expires': expires}
+                 for (address, port), (name, prop) in tivos.items()
+                 if not name.startswith('Proxy(')]
+        names = set(e['name'] for e in fresh)
+        keys = set((e['address'], e['port']) for e in fresh)
+        entries = [e for e in self.entries() if e['name'] not in names and
+                   (e['address'], e['port']) not in keys] + fresh
+        temp = self.filename + '.tmp'
+        try:
+            with open(temp, 'w') as f:
+                json.dump({'tivos': entries}, f, indent=1)
+            getattr(os, 'replace', os.rename)(temp, self.filename)
+        except (IOError, OSError, TypeError):
+            pass
+
+class Framer:
+    """ Split a byte stream into carriage-return-terminated messages,
+        holding any partial message until the rest of it arrives. Data
+        can be received straight into the Framer's buffer (see buffer()
+        and received()), which is allocated once and reused, so that the
+        only copy made is of each complete message.
+
+    """
+    def __init__(self, limit=MAX_COMMAND, size=RECV_SIZE):
+        self.limit = limit
+        self.data = bytearray(limit + size)
+        self.view = memoryview(self.data)
+        self.end = 0
+
+    def buffer(self):
+        """ Return the free part of the buffer, to receive into. """
+        return self.view[self.end:]
+
+    def received(self, count):
+        """ Note that 'count' bytes were put into buffer(), and return a
+            list of the complete messages, each with its terminator.
+            Blank lines (and the line feeds of clients that send CR/LF)
+            are dropped.
+
+        """
+        data = self.data
+        view = self.view
+        end = self.end + count
+        start = 0
+        msgs = []
+        while True:
+            cr = data.find(b'\r', start, end)
+            if cr < 0:
+                break
+            msg = view[start:cr + 1].tobytes()
+            start = cr + 1
+            if msg[:1].isspace() or msg[-2:-1].isspace():
+                msg = msg.strip()
+                if not msg:
+                    continue
+                msg += b'\r'
+            msgs.append(msg)
+        rest = end - start
+        if rest > self.limit:
+            rest = 0
+        elif start and rest:
+            view[:rest] = view[start:end]
+        self.end = rest
+        return msgs
+
+    def feed(self, data):
+        """ Add data received elsewhere, and return a list of the complete
+            messages, as with received().
+
+        """
+        msgs = []
+        data = memoryview(data)
+        while len(data):
+            free = self.buffer()
+            count = min(len(free), len(data))
+            free[:count] = data[:count]
+            msgs.extend(self.received(count))
+            data = data[count:]
+        return msgs
+
+def command_class(msg):
+    """ The first word of a command or status message, e.g. 'IRCODE'. """
+    words = msg.split(None, 1)
+    if words:
+        return words[0].upper()
+    return b''
+
+class Pacer:
+    """ Decide how long to wait after sending each command, before the
+        next. In fixed mode, it's always a tenth of a second. In adaptive
+        mode, each kind of command has its own ceiling, and the wait ends
+        early (though not before PACE_FLOOR) when the TiVo answers with
+        a matching status message.
+
+    """
+    def __init__(self, adaptive=False, ceilings=None):
+        self.adaptive = adaptive
+        self.ceilings = dict(PACE_CEILINGS)
+        if ceilings:
+            self.ceilings.update(ceilings)
+        self.acks = ()
+
+    def sent(self, msg):
+        """ Note a command sent, and return the most time to wait. """
+        if not self.adaptive:
+            return PACE_FIXED
+        kind = command_class(msg)
+        self.acks = PACE_ACKS.get(kind, ())
+        return self.ceilings.get(kind, PACE_FIXED)
+
+    def acked(self, status):
+        """ Return True if a status message from the TiVo answers the
+            last command sent, so the next one can go.
+
+        """
+        if self.acks:
+            for line in status.split(b'\r'):
+                if command_class(line) in self.acks:
+                    self.acks = ()
+                    return True
+        return False
+
+class Scheduler:
+    """ The command queue, with a sub-queue for each client. Clients take
+        turns, so one flooding the TiVo with commands can't hold up the
+        rest; a client with a priority of N gets N commands per turn.
+        Each sub-queue holds at most 'depth' commands; past that, new
+        ones are refused.
+
+        With a coalescing window set, a channel change or teleport
+        replaces any of the same kind still waiting, from any client;
+        and a keypress identical to one from another client within the
+        window is dropped.
+
+    """
+    def __init__(self, depth=QUEUE_DEPTH, priorities=None, window=0):
+        self.depth = depth
+        self.priorities = priorities or {}
+        self.window = window
+        self.recent = {}
+        self.queues = {}
+        self.turns = collections.deque()
+        self.credit = 0
+        self.size = 0
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        return self.size
+
+    def weight(self, key):
+        """ Commands per turn for a client, by its host address. """
+        try:
+            return self.priorities.get(key[0], 1)
+        except:
+            return 1
+
+    def put(self, item, key):
+        """ Add an item to the queue for the client 'key'. Return the
+            list of items dropped by coalescing (which may be just this
+            one), or None if the client's queue is full.
+
+        """
+        with self.cond:
+            dropped = []
+            if self.window:
+                dropped = self.coalesce(item, key)
+                if dropped and dropped[-1] is item:
+                    return dropped
+            queue = self.queues.get(key)
+            if queue is None:
+                queue = self.queues[key] = collections.deque()
+                self.turns.append(key)
+            elif len(queue) >= self.depth:
+                return None
+            queue.append(item)
+            self.size += 1
+            self.cond.notify()
+        return dropped
+
+    def get(self, block=True):
+        """ Return the next item in turn, waiting for one if need be --
+            or if not, returning None when the queue is empty.
+
+        """
+        with self.cond:
+            while not self.size:
+                if not block:
+                    return None
+                self.cond.wait()
+            key = self.turns[0]
+            queue = self.queues[key]
+            if self.credit <= 0:
+                self.credit = self.weight(key)
+            item = queue.popleft()
+            self.size -= 1
+            self.credit -= 1
+            if not queue:
+                self.drop_turn(key)
+            elif self.credit <= 0:
+                self.turns.rotate(-1)
+            return item
+
+    def coalesce(self, new, key):
+        """ Drop any waiting items that the 'new' one supersedes, and
+            return them -- or if 'new' is itself a duplicate, and should
+            be dropped, return [new].
+
+        """
+        msg = new[0]
+        kind = command_class(msg)
+        group = LATEST_WINS.get(kind)
+        dropped = []
+        if group:
+            for qkey, queue in list(self.queues.items()):
+                for item in list(queue):
+                    if LATEST_WINS.get(command_class(item[0])) == group:
+                        queue.remove(item)
+                        self.size -= 1
+                        dropped.append(item)
+                if not queue:
+                    self.drop_turn(qkey)
+        elif kind in KEYPRESSES:
+            now = time.time()
+            last = self.recent.get(msg)
+            if last and last[1] != key and now - last[0] < self.window:
+                return [new]
+            self.recent[msg] = (now, key)
+            if len(self.recent) > 64:
+                for old, when in list(self.recent.items()):
+                    if now - when[0] >= self.window:
+                        del self.recent[old]
+        return dropped
+
+    def drop_turn(self, key):
+        """ Remove a client with nothing left to send from the turns. """
+        del self.queues[key]
+        if self.turns[0] == key:
+            self.credit = 0
+        self.turns.remove(key)
+
+    def clear(self):
+        """ Empty the queue, and return the items that were in it. """
+        with self.cond:
+            items = [item for key in self.turns for item in self.queues[key]]
+            self.queues.clear()
+            self.turns.clear()
+            self.credit = 0
+            self.size = 0
+        return items
+
+class Outbox:
+    """ Status messages waiting to be sent to a client, at most 'limit'
+        of them. When a message arrives to a full outbox, the 'overflow'
+        policy decides: 'oldest' drops the oldest message waiting,
+        'latest' drops all but the new one, and 'drop' means the client
+        should be disconnected. A partly sent message is never dropped.
+
+    """
+    def __init__(self, limit=OUTPUT_LIMIT, overflow='oldest'):
+        self.limit = limit
+        self.overflow = overflow
+        self.msgs = collections.deque()
+        self.partial = False
+
+    def __len__(self):
+        return len(self.msgs)
+
+    def put(self, msg):
+        """ Add a message; return False if the client should be dropped
+            instead.
+
+        """
+        if len(self.msgs) >= self.limit:
+            if self.overflow == 'drop':
+                return False
+            head = self.partial and self.msgs.popleft()
+            if self.overflow == 'latest':
+                self.msgs.clear()
+            elif self.msgs:
+                self.msgs.popleft()
+            if head:
+                self.msgs.appendleft(head)
+        self.msgs.append(msg)
+        return True
+
+    def take(self):
+        """ Remove and return everything waiting, as one string. """
+        data = b''.join(self.msgs)
+        self.msgs.clear()
+        self.partial = False
+        return data
+
+    def sent(self, count):
+        """ Remove the first 'count' bytes, which have been sent. """
+        while count and self.msgs:
+            msg = self.msgs.popleft()
+            if count < len(msg):
+                self.msgs.appendleft(msg[count:])
+                self.partial = True
+                return
+            count -= len(msg)
+            self.partial = False
+
+class Client:
+    """ A connected client remote control program, for Proxy. Status
+        messages are sent without blocking; whatever the socket won't
+        take right away waits in the outbox for the Writer thread.
+
+    """
+    def __init__(self, sock, address, writer, limit=OUTPUT_LIMIT,
+                 overflow='oldest'):
+        self.sock = sock
+        self.address = address
+        self.writer = writer
+        self.outbox = Outbox(limit, overflow)
+        self.lock = threading.Lock()
+        self.closed = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connected = self.last_read = time.time()
+        self.stalled = 0
+
+    def send(self, msg):
+        """ Queue a message for the client, and send it if nothing else
+            is waiting. Return False if the client should be dropped.
+
+        """
+        with self.lock:
+            if self.closed or not self.outbox.put(msg):
+                return False
+            if len(self.outbox) > 1:
+                return True
+            if not DONTWAIT:
+                self.writer.watch(self)
+                return True
+            return self.write()
+
+    def write(self):
+        """ Send as much waiting output as the socket will take, and have
+            the Writer watch for the rest. Call with the lock held.
+            Return False (and mark the client closed) on error. While
+            output remains, self.stalled is
+            the time any of it was last taken.
+
+        """
+        try:
+            if SENDMSG and len(self.outbox) > 1:
+                msgs = list(itertools.islice(self.outbox.msgs, IOV_MAX))
+                count = self.sock.sendmsg(msgs, [], DONTWAIT)
+            else:
+                count = self.sock.send(b''.join(self.outbox.msgs), DONTWAIT)
+        except socket.error as err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.closed = True
+                return False
+            count = 0
+        self.outbox.sent(count)
+        self.bytes_out += count
+        if self.outbox:
+            if count or not self.stalled:
+                self.stalled = time.time()
+            self.writer.watch(self)
+        else:
+            self.stalled = 0
+        return True
+
+    def close(self):
+        """ Close the socket, also waking the read_client() thread. """
+        with self.lock:
+            self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        try:
+            self.sock.close()
+        except:
+            pass
+
+class Registry:
+    """ The clients connected to a Proxy. Adding and removing one takes
+        constant time, and iteration is over a snapshot that's rebuilt
+        only after a change -- so fan_out() doesn't copy the list for
+        every status message, and can drop clients along the way. Call
+        with the Proxy's lock held.
+
+    """
+    def __init__(self):
+        self.clients = set()
+        self.snapshot = ()
+        self.changed = False
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __iter__(self):
+        if self.changed:
+            self.snapshot = tuple(self.clients)
+            self.changed = False
+        return iter(self.snapshot)
+
+    def add(self, client):
+        self.clients.add(client)
+        self.changed = True
+
+    def remove(self, client):
+        """ Remove a client. Return False if it was already gone. """
+        if client not in self.clients:
+            return False
+        self.clients.remove(client)
+        self.changed = True
+        return True
+
+class Writer:
+    """ A thread to finish sending output to clients whose sockets
+        weren't ready for it, so that slow clients never hold up the
+        status_update() thread.
+
+    """
+    def __init__(self):
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.wake, self.waker = socket.socketpair()
+        _thread.start_new_thread(self.run, ())
+
+    def watch(self, client):
+        """ Add a client with output waiting. """
+        with self.lock:
+            if client in self.clients:
+                return
+            self.clients.add(client)
+        try:
+            self.waker.send(b'\0')
+        except socket.error:
+            pass
+
+    def run(self):
+        while True:
+            with self.lock:
+                waiting = dict((c.sock, c) for c in self.clients
+                               if not c.closed)
+                self.clients = set(waiting.values())
+            try:
+                ready = writable(self.wake, list(waiting))
+            except (select.error, socket.error, ValueError):
+                continue
+            for sock in ready:
+                client = waiting[sock]
+                with self.lock:
+                    self.clients.discard(client)
+                with client.lock:
+                    if client.closed:
+                        continue
+                    client.write()
+
+def writable(wake, socks):
+    """ Wait until 'wake' has data (which is discarded), or some of the
+        sockets can be written to, and return those.
+
+    """
+    if hasattr(select, 'poll'):
+        poll = select.poll()
+        poll.register(wake, select.POLLIN)
+        fds = {}
+        for sock in socks:
+            fds[sock.fileno()] = sock
+            poll.register(sock, select.POLLOUT)
+        events = dict(poll.poll())
+        woken = wake.fileno() in events
+        ready = [fds[fd] for fd in events if fd in fds]
+    else:
+        rd, ready, junk = select.select([wake], socks, [])
+        woken = bool(rd)
+    if woken:
+        wake.recv(1024)
+    return ready
+
+class Log:
+    """ Diagnostic messages, written to the console by a thread of their
+        own, so that a slow terminal (or a pipe to a busy logger) never
+        holds up the proxy. Records are formatted by the writer, not the
+        caller. Past LOG_DEPTH waiting, or 'rate' per second (other than
+        errors), they're dropped, and the number dropped is logged.
+
+    """
+    dropped_message = '%d log messages dropped'
+
+    def __init__(self, level='error', as_json=False, rate=0,
+                 out=sys.stderr):
+        self.level = LOG_LEVELS.index(level)
+        self.as_json = as_json
+        self.rate = rate
+        self.out = out
+        self.records = collections.deque()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.dropped = 0
+        self.window = 0
+        self.count = 0
+        self.closing = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def error(self, fmt, *args):
+        self.write(0, fmt, args)
+
+    def info(self, fmt, *args):
+        if self.level >= 1:
+            self.write(1, fmt, args)
+
+    def debug(self, fmt, *args):
+        if self.level >= 2:
+            self.write(2, fmt, args)
+
+    def write(self, level, fmt, args):
+        now = time.time()
+        with self.lock:
+            if self.rate and level:
+                if now - self.window >= 1:
+                    self.window = now
+                    self.count = 0
+                self.count += 1
+                if self.count > self.rate:
+                    self.dropped += 1
+                    return
+            if len(self.records) >= LOG_DEPTH:
+                self.dropped += 1
+                return
+            self.records.append((now, level, fmt, args))
+        self.ready.set()
+
+    def run(self):
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            closing = self.closing
+            with self.lock:
+                records, self.records = self.records, collections.deque()
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                records.append((time.time(), 0, self.dropped_message,
+                                (dropped,)))
+            lines = []
+            for record in records:
+                try:
+                    lines.append(self.format(*record))
+                except Exception as err:
+                    lines.append(self.format(record[0], 0,
+                                             'Bad log message %r: %s',
+                                             (record[2], err)))
+            try:
+                self.out.write(''.join(lines))
+                self.out.flush()
+            except Exception:
+                pass
+            if closing:
+                break
+
+    def format(self, when, level, fmt, args):
+        msg = fmt % args
+        if self.as_json:
+            return json.dumps({'time': round(when, 6),
+                               'level': LOG_LEVELS[level],
+                               'message': msg}) + '\n'
+        return msg + '\n'
+
+    def close(self):
+        """ Write whatever's waiting, and stop. """
+        self.closing = True
+        self.ready.set()
+        self.thread.join(5)
+
+class Metrics:
+    """ Counters and histograms of the proxies' activity, served over
+        HTTP in the Prometheus text format (see --metrics). Labels are
+        tuples of (name, value) pairs.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        """ Add a value (in seconds) to a histogram. """
+        key = (name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def render(self, proxies):
+        """ Return the current metrics as text, including gauges taken
+            from the proxies.
+
+        """
+        gauges = {}
+        for proxy in proxies:
+            labels = proxy.labels
+            with proxy.lock:
+                clients = list(proxy.listeners)
+            gauges[('rproxy_queue_depth', labels)] = len(proxy.queue)
+            gauges[('rproxy_clients', labels)] = len(clients)
+            gauges[('rproxy_connected', labels)] = int(bool(proxy.tivo))
+            for client in clients:
+                clabels = labels + (('client', '%s:%s' % client.address),)
+                gauges[('rproxy_client_received_bytes', clabels)] = \
+                    client.bytes_in
+                gauges[('rproxy_client_sent_bytes', clabels)] = \
+                    client.bytes_out
+                gauges[('rproxy_client_output_waiting', clabels)] = \
+                    len(client.outbox)
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = [(key, hist[:])
+                          for key, hist in self.histograms.items()]
+
+        lines = []
+        for kind, values in (('gauge', gauges.items()),
+                             ('counter', counters)):
+            last = None
+            for (name, labels), value in sorted(values):
+                if name != last:
+                    lines.append('# TYPE %s %s' % (name, kind))
+                    last = name
+                lines.append('%s%s %s' % (name, format_labels(labels),
+                                          value))
+        last = None
+        for (name, labels), hist in sorted(histograms):
+            if name != last:
+                lines.append('# TYPE %s histogram' % name)
+                last = name
+            for bound, count in zip(BUCKETS + ('+Inf',), hist[:-2] +
+                                    [hist[-1]]):
+                lines.append('%s_bucket%s %d' % (name, format_labels(
+                             labels + (('le', str(bound)),)), count))
+            lines.append('%s_sum%s %f' % (name, format_labels(labels),
+                                          hist[-2]))
+            lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                            hist[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def response(self, proxies):
+        """ Return a complete HTTP response with the metrics. """
+        body = self.render(proxies).encode('utf-8')
+        head = ('HTTP/1.0 200 OK\r\n'
+                'Content-Type: text/plain; version=0.0.4\r\n'
+                'Content-Length: %d\r\n'
+                'Connection: close\r\n\r\n' % len(body))
+        return head.encode('ascii') + body
+
+def format_labels(labels):
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label(value))
+                             for name, value in labels)
+
+def escape_label(value):
+    """ Escape a label value for the Prometheus text format. """
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+def class_label(msg):
+    """ The command_class() of a message, as a str, for labels; or
+        'other', if it's not one of COMMAND_CLASSES, so that whatever
+        clients send can't add series without limit.
+
+    """
+    cls = command_class(msg)
+    if cls in COMMAND_CLASSES:
+        return cls.decode('ascii')
+    return 'other'
+
+class Trace:
+    """ The timeline of one sampled command: when it was received from
+        the client, taken from the queue, sent to the TiVo, and followed
+        by a status message.
+
+    """
+    def __init__(self, target, address, msg, received):
+        self.target = target
+        self.address = address
+        self.msg = msg
+        self.received = received
+        self.dequeued = None
+        self.sent = None
+        self.answered = None
+        self.status = None
+        self.outcome = 'sent'
+
+    def record(self):
+        """ Return the trace as a dict, with the stages in milliseconds.
+            A stage not reached is None.
+
+        """
+        def ms(start, end):
+            if start is None or end is None:
+                return None
+            return round((end - start) * 1000, 3)
+
+        last = self.answered or self.sent or self.dequeued or time.time()
+        return {'target': '%s:%d' % self.target,
+                'client': '%s:%d' % self.address,
+                'command': self.msg.strip().decode('ascii', 'replace'),
+                'received': round(self.received, 6),
+                'queued': ms(self.received, self.dequeued),
+                'sending': ms(self.dequeued, self.sent),
+                'response': ms(self.sent, self.answered),
+                'total': ms(self.received, last),
+                'status': self.status and
+                          self.status.strip().decode('ascii', 'replace'),
+                'outcome': self.outcome}
+
+class Tracer(Log):
+    """ Write the Traces of a sample of commands to a file, one JSON
+        object per line (see --trace). Like the Log, it's written by a
+        thread of its own; past LOG_DEPTH waiting, traces are dropped,
+        and the number dropped is noted in the file.
+
+    """
+    dropped_message = '%d traces dropped'
+
+    def __init__(self, filename, rate=1.0):
+        if filename == '-':
+            out = sys.stdout
+        else:
+            out = open(filename, 'a')
+        Log.__init__(self, as_json=True, out=out)
+        self.sample_rate = rate
+
+    def sample(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def write(self, trace):
+        Log.write(self, 0, None, trace.record())
+
+    def format(self, when, level, fmt, args):
+        if fmt is None:
+            return json.dumps(args, sort_keys=True) + '\n'
+        return Log.format(self, when, level, fmt, args)
+
+    def close(self):
+        Log.close(self)
+        if self.out is not sys.stdout:
+            self.out.close()
+
 class Proxy:
-    def __init__(self, target, host_port=DEFAULT_HOST, verbose=False,
-                 reconnect=True):
-        self.queue = Queue()
-        self.listeners = []
+    """ Proxy one TiVo, for clients connecting on one port. The engine
+        runs it, along with any others in the same process.
+
+    """
+    def __init__(self, engine, target, host_port=DEFAULT_HOST,
+                 reconnect=True, adaptive=False, ceilings=None,
+                 depth=QUEUE_DEPTH, priorities=None, coalesce=0,
+                 limit=OUTPUT_LIMIT, overflow='oldest',
+                 backoff=BACKOFF_MAX, hold=HOLD, max_ages=None, batch=0,
+                 unix=None, tcp=True, keepalive=KEEPALIVE, nodelay=True,
+                 probe=0, idle=0, max_clients=0, accept_policy='refuse',
+                 tries=None):
+        self.engine = engine
+        self.log = engine.log
+        self.metrics = engine.metrics
+        self.tracer = engine.tracer
+        self.traced = []
+        self.labels = (('target', '%s:%d' % target),)
+        self.queue = Scheduler(depth, priorities, coalesce)
+        self.listeners = Registry()
         self.target = target
-        self.verbose = verbose
         self.host_port = host_port
         self.reconnect = reconnect
-        self.connect()
+        self.pacer = Pacer(adaptive, ceilings)
+        self.limit = limit
+        self.overflow = overflow
+        self.tivo = None
+        self.connecting = False
+        self.framer = Framer()
+        self.latest = []
+        self.lock = threading.Lock()
+        self.ack = threading.Event()
+        self.up = threading.Event()
+        self.down = threading.Event()
+        self.down.set()
+        self.backoff = backoff
+        self.hold = hold
+        self.batch = batch
+        self.max_ages = dict(MAX_AGES)
+        if max_ages:
+            self.max_ages.update(max_ages)
+        self.delay = BACKOFF_MIN
+        self.closed = False
+        self.server = None
+        self.unix = unix
+        self.unix_server = None
+        self.tcp = tcp
+        self.keepalive = keepalive
+        self.nodelay = nodelay
+        self.probe = probe
+        self.last_io = 0
+        self.idle = idle
+        self.max_clients = max_clients
+        self.accept_policy = accept_policy
+        if tries is None:
+            if host_port[1] == DEFAULT_HOST[1]:
+                tries = 10
+            else:
+                tries = 1
+        self.tries = tries
+
+    def start(self):
+        """ Open the server port, and start the process_queue() and
+            supervise() threads; the latter connects to the TiVo, so
+            that one that's slow to answer doesn't hold up the rest.
+            Return False if no port was free.
+
+        """
+        if not self.open_servers():
+            return False
+        self.connecting = True
         _thread.start_new_thread(self.process_queue, ())
-        self.serve()
-        self.cleanup()
+        _thread.start_new_thread(self.supervise, ())
+        return True
+
+    def supervise(self):
+        """ Connect to the TiVo, and reconnect whenever the connection is
+            lost, in the background. After each failed attempt, wait
+            longer (doubling, with some randomness, up to self.backoff
+            seconds). Meanwhile, probe the connection, if so configured.
+
+        """
+        while not self.closed:
+            if not self.down.wait(self.probe or None):
+                self.probe_tivo()
+                continue
+            if self.closed or not (self.connecting or self.reconnect):
+                break
+            if self.connect():
+                self.delay = BACKOFF_MIN
+            elif self.reconnect:
+                time.sleep(self.next_delay())
+            self.connecting = False
+
+    def probe_tivo(self):
+        """ If the link to the TiVo has been idle for self.probe seconds,
+            send a blank line. The TiVo ignores it; but if the TiVo is
+            gone, the write fails (or goes unacknowledged, and the
+            TCP_USER_TIMEOUT ends the connection), rather than the loss
+            going unnoticed until the next command.
+
+        """
+        tivo = self.tivo
+        if tivo and time.time() - self.last_io >= self.probe:
+            self.last_io = time.time()
+            try:
+                tivo.sendall(b'\r')
+            except Exception as err:
+                self.log.info('%s', err)
+                if tivo is self.tivo:
+                    self.disconnect()
+
+    def retarget(self, address):
+        """ Connect to the TiVo at a new address from now on, as when it
+            has moved (see ZCBroadcast.track()).
+
+        """
+        if address != self.target:
+            self.log.info('TiVo at %s, port %d moved to %s, port %d',
+                          *(self.target + address))
+            self.target = address
+            self.delay = BACKOFF_MIN
+
+    def defer(self, address):
+        """ Connect through the proxy at 'address' from now on, the TiVo
+            having turned out to be proxied there already; and drop any
+            direct connection, which would take the TiVo's only one.
+
+        """
+        self.log.info('TiVo at %s, port %d is already proxied at %s, '
+                      'port %d', *(self.target + address))
+        self.target = address
+        self.delay = BACKOFF_MIN
+        self.hang_up()
+
+    def hang_up(self):
+        """ End the connection to the TiVo, from any thread. The
+            status_update() thread notices, and reconnection follows as
+            usual.
+
+        """
+        tivo = self.tivo
+        if tivo:
+            try:
+                tivo.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+
+    def next_delay(self):
+        """ Return the wait before the next attempt to reconnect. """
+        delay = random.uniform(self.delay / 2, self.delay)
+        self.delay = min(self.delay * 2, self.backoff)
+        return delay
+
+    def running(self):
+        return self.tivo or self.reconnect or self.connecting
+
+    def open_servers(self):
+        """ Start serving clients on the TCP port, the Unix socket, or
+            both. Return False if either couldn't be opened.
+
+        """
+        if self.tcp:
+            self.server = self.listen()
+            if not self.server:
+                return False
+        if self.unix:
+            self.unix_server = self.listen_unix()
+            if not self.unix_server:
+                if self.server:
+                    self.server.close()
+                return False
+        return True
+
+    def servers(self):
+        return [s for s in (self.server, self.unix_server) if s]
 
     def process_queue(self):
         """ Pop commands from the queue and send them to the TiVo. Wait
-            100ms between messages to avoid a bit jam.
+            100ms between commands to avoid a bit jam -- or in adaptive
+            mode, as long as the Pacer says.
 
         """
         while True:
-            msg, address = self.queue.get()
-            if not self.tivo:
-                if self.reconnect:
-                    self.connect()
-                else:
+            msg, client, stamp, trace = self.queue.get()
+            if not msg:
+                break
+            if trace:
+                trace.dequeued = time.time()
+            if not self.send_command(msg, client, stamp, trace):
+                if self.closed or not self.running():
                     break
-            if self.verbose:
-                sys.stderr.write('%s: %s\n' % (address, msg))
+                continue
+            start = time.time()
+            if self.ack.wait(self.pacer.sent(msg)):
+                time.sleep(max(0, start + PACE_FLOOR - time.time()))
+
+    def send_command(self, msg, client, stamp, trace=None):
+        """ Send a command to the TiVo, waiting for it to reconnect if
+            need be, unless the command has expired. Return True if sent.
+
+        """
+        while self.wait_for_tivo((msg, client, stamp, trace)):
+            if self.expired(msg, client, stamp, trace):
+                return False
+            self.log.debug('%s: %s', client.address, msg)
+            self.ack.clear()
+            tivo = self.tivo
             try:
-                self.tivo.sendall(msg)
-            except:
-                break
-            time.sleep(0.1)
+                start = time.time()
+                tivo.sendall(msg)
+                self.last_io = time.time()
+                self.count_sent(msg, stamp, start)
+                if trace:
+                    self.trace_sent(trace)
+                return True
+            except Exception as err:
+                self.log.info('%s', err)
+                if tivo is self.tivo:
+                    self.disconnect()
+        return False
+
+    def count_sent(self, msg, stamp, start):
+        """ Record the time a command spent in the queue and being sent. """
+        if self.metrics:
+            now = time.time()
+            labels = self.labels + (('class', class_label(msg)),)
+            self.metrics.inc('rproxy_commands_sent_total', labels)
+            self.metrics.observe('rproxy_queue_wait_seconds', labels,
+                                 start - stamp)
+            self.metrics.observe('rproxy_send_seconds', labels, now - start)
+
+    def count_dropped(self, reason, count=1):
+        if self.metrics:
+            self.metrics.inc('rproxy_commands_dropped_total',
+                             self.labels + (('reason', reason),), count)
+
+    def trace_sent(self, trace):
+        """ Note that a traced command was sent; its trace is finished by
+            the next status message. If the TiVo never answers, the
+            oldest traces are written without a status.
 
-    def read_client(self, client, address):
+        """
+        trace.sent = time.time()
+        stale = None
+        with self.lock:
+            self.traced.append(trace)
+            if len(self.traced) > QUEUE_DEPTH:
+                stale = self.traced.pop(0)
+        if stale:
+            self.tracer.write(stale)
+
+    def trace_status(self, status):
+        """ Finish the traces of the commands sent before this status. """
+        now = time.time()
+        with self.lock:
+            traced, self.traced = self.traced, []
+        for trace in traced:
+            trace.answered = now
+            trace.status = status
+            self.tracer.write(trace)
+            if self.metrics:
+                self.metrics.observe('rproxy_response_seconds', self.labels +
+                                     (('class', class_label(trace.msg)),),
+                                     now - trace.sent)
+
+    def trace_dropped(self, trace, outcome):
+        trace.outcome = outcome
+        self.tracer.write(trace)
+
+    def expired(self, msg, client, stamp, trace=None):
+        """ Return True if a command has waited too long to be sent, per
+            self.max_ages, and tell the client that sent it.
+
+        """
+        age = time.time() - stamp
+        if age <= self.max_ages.get(command_class(msg), self.max_ages[b'*']):
+            return False
+        self.log.info('%s: %s expired after %.1fs', client.address, msg, age)
+        self.count_dropped('expired')
+        if trace:
+            self.trace_dropped(trace, 'expired')
+        client.send(EXPIRED + msg)
+        return True
+
+    def wait_for_tivo(self, held):
+        """ Return True once connected to the TiVo. While it's away, hold
+            the commands; but if it's not back within self.hold seconds,
+            drop them all, along with 'held' (the one being sent), and
+            return False.
+
+        """
+        if self.up.is_set():
+            return True
+        if (self.reconnect or self.connecting) and self.up.wait(self.hold):
+            return True
+        self.drop_held(held)
+        return False
+
+    def drop_held(self, held=None):
+        """ Drop all the queued commands (and 'held', if given), and tell
+            the clients that sent them.
+
+        """
+        items = self.queue.clear()
+        if held:
+            items.insert(0, held)
+        if not items:
+            return
+        self.count_dropped('unavailable', len(items))
+        for msg, client, stamp, trace in items:
+            if trace:
+                self.trace_dropped(trace, 'unavailable')
+            client.send(DROPPED + msg)
+        self.log.info('TiVo at %s, port %d unavailable; %d commands dropped',
+                      self.target[0], self.target[1], len(items))
+
+    def read_client(self, client):
         """ Read commands from a client remote control program, and put them
-            in the queue. Run until the client disconnects.
+            in the queue, one complete command at a time. Run until the
+            client disconnects.
 
         """
-        if self.verbose:
-            sys.stderr.write('Client connection from %s, port %d\n' % address)
+        address = client.address
+        self.log.info('Client connection from %s, port %d', *address)
+        framer = Framer()
         while True:
             try:
-                msg = client.recv(1024)
+                count = client.sock.recv_into(framer.buffer())
             except Exception as err:
-                if self.verbose:
-                    sys.stderr.write('%s\n' % str(err))
+                self.log.info('%s', err)
                 break
-            if not msg:
+            if not count:
                 break
-            self.queue.put((msg, address))
-        try:
-            client.close()
-        except:
-            pass
-        if self.verbose:
-            sys.stderr.write('Client at %s, port %d disconnected\n' % address)
+            client.bytes_in += count
+            client.last_read = time.time()
+            for cmd in framer.received(count):
+                self.queue_command(cmd, client)
+        with self.lock:
+            self.listeners.remove(client)
+        client.close()
+        self.log.info('Client at %s, port %d disconnected', *address)
+
+    def queue_command(self, cmd, client):
+        """ Queue a command from a client, noting the time, and sampling
+            it for tracing.
+
+        """
+        address = client.address
+        stamp = time.time()
+        trace = None
+        if self.tracer and self.tracer.sample():
+            trace = Trace(self.target, address, cmd, stamp)
+        dropped = self.queue.put((cmd, client, stamp, trace), address)
+        if dropped is None:
+            self.count_dropped('full')
+            if trace:
+                self.trace_dropped(trace, 'full')
+            self.log.info('Queue full for %s, port %d; dropped %s',
+                          *(address + (cmd,)))
+        elif dropped:
+            self.count_dropped('coalesced', len(dropped))
+            for msg, sender, stamp, trace in dropped:
+                if trace:
+                    self.trace_dropped(trace, 'coalesced')
+                self.log.debug('Coalesced %s from %s, port %d',
+                               *((msg,) + sender.address))
 
     def status_update(self):
         """ Read status response messages from the TiVo, and send them to
             each connected client.
 
         """
+        tivo = self.tivo
+        inbox = bytearray(RECV_SIZE)
+        view = memoryview(inbox)
         while True:
             try:
-                status = self.tivo.recv(1024)
+                count = tivo.recv_into(inbox)
+                if count and self.batch:
+                    count = self.gather(tivo, view, count)
             except Exception as err:
-                if self.verbose:
-                    sys.stderr.write('%s\n' % str(err))
-                status = ''
-            if not status:
-                self.disconnect()
+                self.log.info('%s', err)
+                count = 0
+            if not count:
+                if tivo is self.tivo:
+                    self.disconnect()
                 break
-            if self.verbose:
-                sys.stderr.write('%s: %s\n' % (self.target, status))
-            for l in self.listeners[:]:
-                try:
-                    l.sendall(status)
-                except:
-                    self.listeners.remove(l)
+            self.send_status(view[:count].tobytes())
+
+    def gather(self, tivo, view, count):
+        """ Keep receiving status messages into 'view' for self.batch
+            seconds after the first, or until it's full, so that a burst
+            of them (as when channel surfing) goes to each client at once.
+            Return the total received.
+
+        """
+        limit = time.time() + self.batch
+        while count < len(view):
+            wait = limit - time.time()
+            if wait <= 0 or not select.select([tivo], [], [], wait)[0]:
+                break
+            more = tivo.recv_into(view[count:])
+            if not more:
+                break   # The next recv_into() will find the disconnection
+            count += more
+        return count
+
+    def send_status(self, status):
+        """ Send a status message from the TiVo to each connected client.
+            Clients that can't keep up have it buffered, so this doesn't
+            block.
+
+        """
+        self.last_io = time.time()
+        if self.pacer.acked(status):
+            self.ack.set()
+        if self.traced:
+            self.trace_status(status)
+        self.fan_out(status)
+
+    def fan_out(self, status):
+        self.log.debug('%s: %s', self.target, status)
+        start = time.time()
+        with self.lock:
+            self.cache_status(status)
+            for l in self.listeners:
+                if not l.send(status):
+                    self.drop_client(l, 'error' if l.closed else 'overflow')
+        if self.metrics:
+            self.metrics.observe('rproxy_fanout_seconds', self.labels,
+                                 time.time() - start)
+            self.metrics.inc('rproxy_status_bytes_total', self.labels,
+                             len(status))
+
+    def cache_status(self, status):
+        """ Keep the latest status message of each kind in CACHED_STATUS,
+            in the order received, to bring new clients up to date.
+
+        """
+        for line in self.framer.feed(status):
+            kind = command_class(line)
+            if kind in CACHED_STATUS:
+                self.latest = [l for l in self.latest
+                               if command_class(l) != kind] + [line]
+
+    def add_client(self, client):
+        """ Send the cached status to a new client, and add it to the
+            listeners. Return False if it's refused (see make_room()).
+
+        """
+        with self.lock:
+            if not self.make_room():
+                return False
+            for status in self.latest:
+                client.send(status)
+            self.listeners.add(client)
+        return True
+
+    def make_room(self):
+        """ If self.max_clients are already connected, apply the accept
+            policy: return False to refuse the new client, or drop the
+            oldest or longest idle one. Call with the lock held.
+
+        """
+        if not self.max_clients or len(self.listeners) < self.max_clients:
+            return True
+        if self.accept_policy == 'refuse':
+            self.count_client_drop('refused')
+            return False
+        if self.accept_policy == 'oldest':
+            victim = min(self.listeners, key=lambda l: l.connected)
+        else:
+            victim = min(self.listeners, key=lambda l: l.last_read)
+        self.drop_client(victim, self.accept_policy)
+        return True
+
+    def drop_client(self, client, reason='overflow'):
+        """ Disconnect a client that has failed or fallen too far behind,
+            or for the given reason. Call with the lock held.
+
+        """
+        if not self.listeners.remove(client):
+            return
+        self.count_client_drop(reason)
+        self.log.info('Dropping client at %s, port %d (%s)',
+                      *(client.address + (reason,)))
+        client.close()
+
+    def count_client_drop(self, reason):
+        if self.metrics:
+            self.metrics.inc('rproxy_client_drops_total',
+                             self.labels + (('reason', reason),))
+
+    def reap(self):
+        """ Drop clients that have sent nothing for self.idle seconds (if
+            set), or whose output has been stuck for STALL seconds --
+            most likely, they vanished without closing the connection.
+
+        """
+        now = time.time()
+        with self.lock:
+            for l in self.listeners:
+                if l.stalled and now - l.stalled > STALL:
+                    self.drop_client(l, 'stalled')
+                elif self.idle and now - l.last_read > self.idle:
+                    self.drop_client(l, 'idle')
 
     def connect(self):
-        """ Connect to the target TiVo within five seconds, or abort. """
+        """ Connect to the target TiVo within five seconds, or abort.
+            Return True if connected.
+
+        """
         try:
             tivo = socket.socket()
+            tune_socket(tivo, self.keepalive, self.nodelay)
             tivo.settimeout(5)
             tivo.connect(self.target)
             tivo.settimeout(None)
         except Exception as err:
-            if self.verbose:
-                sys.stderr.write('%s\n' % str(err))
+            self.log.info('%s', err)
             self.tivo = None
-        else:
-            if self.verbose:
-                sys.stderr.write('Connected to TiVo at %s, port %d\n' %
-                                  self.target)
-            self.tivo = tivo
-            _thread.start_new_thread(self.status_update, ())
+            self.count_connect('failed')
+            return False
+        self.count_connect('ok')
+        self.log.info('Connected to TiVo at %s, port %d', *self.target)
+        self.tivo = tivo
+        self.down.clear()
+        self.up.set()
+        _thread.start_new_thread(self.status_update, ())
+        return True
+
+    def count_connect(self, result):
+        if self.metrics:
+            self.metrics.inc('rproxy_connects_total',
+                             self.labels + (('result', result),))
 
     def disconnect(self):
+        if self.metrics:
+            self.metrics.inc('rproxy_disconnects_total', self.labels)
         try:
             self.tivo.close()
         except:
             pass
-        if self.verbose:
-            sys.stderr.write('Disconnected from TiVo at %s, port %d\n' %
-                              self.target)
-        self.tivo = None        
-
-    def serve(self):
-        """ Listen for connections from client remote control programs;
-            start new read_client() threads and add listeners as needed.
-            Serve until KeyboardInterrupt.
+        self.log.info('Disconnected from TiVo at %s, port %d', *self.target)
+        self.tivo = None
+        self.up.clear()
+        self.down.set()
+        self.framer = Framer()
+        self.latest = []
+
+    def listen(self):
+        """ Open the port for client remote control programs, trying the
+            next ones if it's in use, per self.tries. Return the socket,
+            or None, and update host_port with the port used.
 
         """
         addr, port = self.host_port
-        if port == DEFAULT_HOST[1]:
-            tries = 10
-        else:
-            tries = 1
+        tries = self.tries
         server = socket.socket()
+        if os.name == 'posix':  # Elsewhere, it would allow sharing a port
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         while tries:
             try:
                 server.bind((addr, port))
                 break
             except:
                 tries -= 1
-                if self.verbose or not tries:
-                    sys.stderr.write('Port %d already in use\n' % port)
-                if not tries:
-                    return
+                if tries:
+                    self.log.info('Port %d already in use', port)
+                else:
+                    self.log.error('Port %d already in use', port)
+                    server.close()
+                    return None
                 port += 1
-        server.listen(5)
+        server.listen(BACKLOG)
+        self.host_port = (addr, port)
+        return server
+
+    def listen_unix(self):
+        """ Start serving clients on the Unix socket self.unix. Return the
+            socket, or None.
 
+        """
         try:
-            while self.tivo or self.reconnect:
-                isock, junk1, junk2 = select.select([server], [], [], 1)
-                if not isock:
-                    continue
-                client, address = server.accept()
-                self.listeners.append(client)
-                _thread.start_new_thread(self.read_client, (client, address))
-        except KeyboardInterrupt:
-            pass
+            remove_socket(self.unix)
+            server = socket.socket(socket.AF_UNIX)
+            server.bind(self.unix)
+            server.listen(BACKLOG)
+        except (socket.error, OSError, AttributeError) as err:
+            self.log.error('%s: %s', self.unix, err)
+            return None
+        return server
+
+    def accept(self, server=None):
+        """ Accept a connection from a client remote control program, add
+            it to the listeners, and start a read_client() thread.
+
+        """
+        server = server or self.server
+        sock, address = server.accept()
+        if server is self.unix_server:
+            address = unix_address(self.unix, sock)
+        else:
+            tune_socket(sock, self.keepalive, self.nodelay)
+        client = Client(sock, address, self.engine.writer, self.limit,
+                        self.overflow)
+        if not self.add_client(client):
+            self.log.info('Refusing client at %s, port %d', *address)
+            client.close()
+            return
+        _thread.start_new_thread(self.read_client, (client,))
 
     def cleanup(self):
         """ Close all sockets, and push one last message to make the
             process_queue() thread exit.
 
         """
-        for l in [self.tivo] + self.listeners:
+        self.closed = True
+        self.down.set()
+        with self.lock:
+            clients = list(self.listeners)
+        for l in self.servers() + [self.tivo] + clients:
             try:
                 l.close()
             except:
                 pass
+        if self.unix_server:
+            remove_socket(self.unix)
+
+        self.queue.put(('', None, 0, None), None)
+
+class ThreadEngine:
+    """ Run proxies with threads: one for each client, and two for each
+        TiVo (status_update() and process_queue()). The main thread
+        accepts clients for all of them, and one Writer thread finishes
+        sending for all.
+
+    """
+    proxy_class = Proxy
+
+    def __init__(self, metrics=None, tracer=None, log=None):
+        self.writer = Writer()
+        self.proxies = []
+        self.log = log or Log()
+        self.tracer = tracer
+        self.metrics = None
+        self.metrics_server = None
+        if metrics:
+            self.metrics = Metrics()
+            self.metrics_server = self.serve_metrics(metrics)
+
+    def add(self, *args, **kwargs):
+        """ Create and start a proxy. Return it, or None if it couldn't
+            be started.
+
+        """
+        proxy = self.proxy_class(self, *args, **kwargs)
+        if not proxy.start():
+            return None
+        self.proxies.append(proxy)
+        return proxy
+
+    def serve(self):
+        """ Accept clients for all the proxies until KeyboardInterrupt,
+            or until none are left running (see -x); then clean up.
+
+        """
+        reaped = time.time()
+        try:
+            while True:
+                if time.time() - reaped >= REAP_INTERVAL:
+                    reaped = time.time()
+                    for proxy in self.proxies:
+                        proxy.reap()
+                for proxy in self.proxies[:]:
+                    if not proxy.running():
+                        proxy.cleanup()
+                        self.proxies.remove(proxy)
+                if not self.proxies:
+                    break
+                servers = dict((s, p) for p in self.proxies
+                               for s in p.servers())
+                if self.metrics_server:
+                    servers[self.metrics_server] = None
+                isock, junk1, junk2 = select.select(list(servers), [], [], 1)
+                for server in isock:
+                    try:
+                        if server is self.metrics_server:
+                            sock, address = server.accept()
+                            _thread.start_new_thread(self.send_metrics,
+                                                     (sock,))
+                        else:
+                            servers[server].accept(server)
+                    except socket.error as err:
+                        self.log.error('Accepting a connection: %s', err)
+                        if err.args[0] in (errno.EMFILE, errno.ENFILE):
+                            time.sleep(0.1)  # Until some are closed
+        except KeyboardInterrupt:
+            pass
+        for proxy in self.proxies:
+            proxy.cleanup()
+
+    def serve_metrics(self, host_port):
+        """ Open the port for metrics requests. """
+        try:
+            server = socket.socket()
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(host_port)
+            server.listen(5)
+        except socket.error as err:
+            self.log.error('Metrics port %d: %s', host_port[1], err)
+            return None
+        return server
+
+    def send_metrics(self, sock):
+        """ Answer any HTTP request with the metrics. """
+        try:
+            sock.settimeout(5)
+            request = b''
+            while b'\r\n\r\n' not in request and b'\n\n' not in request:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                request += data
+            sock.sendall(self.metrics.response(self.proxies))
+        except socket.error:
+            pass
+        sock.close()
+
+def tune_socket(sock, keepalive=KEEPALIVE, nodelay=True):
+    """ Set up a TCP socket for low latency, and for noticing quickly if
+        the other end vanishes: with TCP_NODELAY, small writes go out at
+        once; with keepalive probes and TCP_USER_TIMEOUT, a dead
+        connection is found within about twice 'keepalive' seconds,
+        whether idle or with data unacknowledged. Options the platform
+        lacks are skipped.
+
+    """
+    options = []
+    if nodelay:
+        options.append((socket.IPPROTO_TCP, 'TCP_NODELAY', 1))
+    if keepalive:
+        interval = max(1, int(keepalive) // KEEPALIVE_PROBES)
+        options += [(socket.SOL_SOCKET, 'SO_KEEPALIVE', 1),
+                    (socket.IPPROTO_TCP, 'TCP_KEEPIDLE', int(keepalive)),
+                    (socket.IPPROTO_TCP, 'TCP_KEEPALIVE', int(keepalive)),
+                    (socket.IPPROTO_TCP, 'TCP_KEEPINTVL', interval),
+                    (socket.IPPROTO_TCP, 'TCP_KEEPCNT', KEEPALIVE_PROBES),
+                    (socket.IPPROTO_TCP, 'TCP_USER_TIMEOUT',
+                     int(keepalive * 2000))]
+    for level, name, value in options:
+        option = getattr(socket, name, None)
+        if option is not None:
+            try:
+                sock.setsockopt(level, option, value)
+            except (socket.error, OSError):
+                pass
+
+def unix_address(path, sock):
+    """ A stand-in for the (host, port) address of a client connected on
+        a Unix socket, which has none: the path, and the descriptor.
+
+    """
+    return ('unix:' + path, sock.fileno())
 
-        self.queue.put(('', ''))
+def remove_socket(path):
+    """ Remove a Unix socket left from an earlier run, unless something is
+        still listening on it. Anything other than a socket is left alone
+        (and bind() will fail).
+
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except OSError:
+        return
+    probe = socket.socket(socket.AF_UNIX)
+    try:
+        probe.connect(path)
+    except socket.error:
+        os.unlink(path)
+    finally:
+        probe.close()
+
+_Protocol = asyncio.Protocol if asyncio else object
+_BufferedProtocol = getattr(asyncio, 'BufferedProtocol', _Protocol)
+
+class TiVoProtocol(_Protocol):
+    """ The connection to the TiVo, for AsyncProxy. """
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def data_received(self, data):
+        self.proxy.gather(data)
+
+    def connection_lost(self, exc):
+        if exc:
+            self.proxy.log.info('%s', exc)
+        self.proxy.disconnect()
+
+class ClientProtocol(_BufferedProtocol):
+    """ A connection from a client remote control program, for
+        AsyncProxy. Once the transport has WRITE_BUFFER bytes waiting,
+        status messages go to a bounded outbox instead, until it drains.
+        Commands are received straight into the Framer's buffer, where
+        the event loop supports it (Python 3.7 and later).
+
+    """
+    def __init__(self, proxy, unix=None):
+        self.proxy = proxy
+        self.unix = unix
+        self.transport = None
+        self.address = None
+        self.framer = Framer()
+        self.outbox = Outbox(proxy.limit, proxy.overflow)
+        self.paused = False
+        self.closed = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connected = self.last_read = time.time()
+        self.stalled = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.unix:
+            self.address = unix_address(self.unix,
+                                        transport.get_extra_info('socket'))
+        else:
+            self.address = transport.get_extra_info('peername')[:2]
+            tune_socket(transport.get_extra_info('socket'),
+                        self.proxy.keepalive, self.proxy.nodelay)
+        transport.set_write_buffer_limits(WRITE_BUFFER)
+        if not self.proxy.add_client(self):
+            self.proxy.log.info('Refusing client at %s, port %d',
+                                *self.address)
+            transport.abort()
+            return
+        self.proxy.log.info('Client connection from %s, port %d',
+                            *self.address)
+
+    def get_buffer(self, sizehint):
+        return self.framer.buffer()
+
+    def buffer_updated(self, nbytes):
+        self.bytes_in += nbytes
+        self.last_read = time.time()
+        self.queue_commands(self.framer.received(nbytes))
+
+    def data_received(self, data):
+        self.bytes_in += len(data)
+        self.last_read = time.time()
+        self.queue_commands(self.framer.feed(data))
+
+    def queue_commands(self, cmds):
+        for cmd in cmds:
+            self.proxy.queue_command(cmd, self)
+        self.proxy.process_queue()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if exc:
+            self.proxy.log.info('%s', exc)
+        with self.proxy.lock:
+            self.proxy.listeners.remove(self)
+        self.proxy.log.info('Client at %s, port %d disconnected',
+                            *self.address)
+
+    def pause_writing(self):
+        self.paused = True
+        self.stalled = time.time()
+
+    def resume_writing(self):
+        self.paused = False
+        self.stalled = 0
+        if self.outbox:
+            msgs = list(self.outbox.msgs)
+            self.outbox.take()
+            self.bytes_out += sum(len(msg) for msg in msgs)
+            self.transport.writelines(msgs)
+
+    def send(self, msg):
+        """ Write a message, or hold it if the transport is backed up.
+            Return False if the client should be dropped.
+
+        """
+        if self.paused:
+            return self.outbox.put(msg)
+        self.bytes_out += len(msg)
+        self.transport.write(msg)
+        return True
+
+    def close(self):
+        self.transport.abort()
+
+class MetricsProtocol(_Protocol):
+    """ Answer any HTTP request with the metrics, for AsyncEngine. """
+    def __init__(self, engine):
+        self.engine = engine
+        self.request = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.request += data
+        if b'\r\n\r\n' in self.request or b'\n\n' in self.request:
+            self.transport.write(self.engine.metrics.response(
+                                 self.engine.proxies))
+            self.transport.close()
+
+class AsyncProxy(Proxy):
+    """ The same service as Proxy, but run from a single thread by an
+        asyncio event loop, instead of a thread per client. Sockets are
+        handled by asyncio transports; the pacing between commands is
+        done with timers rather than sleep().
+
+    """
+    def start(self):
+        """ Open the server port, and start connecting to the TiVo; the
+            connection is made once the event loop runs. Return False if
+            no port was free.
+
+        """
+        self.paused = False
+        self.timer = None
+        self.connect_task = None
+        self.hold_timer = None
+        self.batch_timer = None
+        self.gathered = []
+        self.sent_at = 0
+        self.loop = self.engine.loop
+        if not self.open_servers():
+            return False
+        if self.probe:
+            self.loop.call_later(self.probe, self.probe_tivo)
+        self.connect()
+        return True
+
+    def process_queue(self):
+        """ Send the next command from the queue to the TiVo, unless the
+            pause after the last one isn't over, or we're still
+            connecting. A timer calls back here when the pause is over.
+
+        """
+        if self.paused or not self.queue:
+            return
+        if not self.tivo:
+            if not (self.reconnect or self.connecting):
+                self.drop_held()
+            elif not self.hold_timer:
+                self.hold_timer = self.loop.call_later(self.hold,
+                                                       self.drop_held)
+            return
+        item = self.queue.get(False)
+        while item and self.expired(*item):
+            item = self.queue.get(False)
+        if not item:
+            return
+        msg, client, stamp, trace = item
+        self.log.debug('%s: %s', client.address, msg)
+        start = time.time()
+        self.tivo.write(msg)
+        self.last_io = start
+        self.count_sent(msg, stamp, start)
+        if trace:
+            trace.dequeued = start
+            self.trace_sent(trace)
+        self.paused = True
+        self.sent_at = self.loop.time()
+        self.timer = self.loop.call_later(self.pacer.sent(msg), self.unpause)
+
+    def probe_tivo(self):
+        """ As Proxy.probe_tivo(), but on a timer. A failed write shows up
+            in TiVoProtocol.connection_lost().
+
+        """
+        if self.closed:
+            return
+        if self.tivo and time.time() - self.last_io >= self.probe:
+            self.last_io = time.time()
+            self.tivo.write(b'\r')
+        self.loop.call_later(self.probe, self.probe_tivo)
+
+    def unpause(self):
+        self.paused = False
+        self.process_queue()
+
+    def drop_held(self):
+        self.hold_timer = None
+        Proxy.drop_held(self)
+
+    def gather(self, status):
+        """ Hold status messages for self.batch seconds after the first,
+            then send them all at once.
+
+        """
+        if not self.batch:
+            self.send_status(status)
+            return
+        self.gathered.append(status)
+        if not self.batch_timer:
+            self.batch_timer = self.loop.call_later(self.batch,
+                                                    self.send_gathered)
+
+    def send_gathered(self):
+        self.batch_timer = None
+        status, self.gathered = b''.join(self.gathered), []
+        if status:
+            self.send_status(status)
+
+    def send_status(self, status):
+        """ Send a status message from the TiVo to each connected client.
+            Transports and outboxes buffer the data, so this never blocks.
+
+        """
+        self.last_io = time.time()
+        if self.pacer.acked(status) and self.paused:
+            self.timer.cancel()
+            self.timer = self.loop.call_at(self.sent_at + PACE_FLOOR,
+                                           self.unpause)
+        if self.traced:
+            self.trace_status(status)
+        self.fan_out(status)
+
+    def connect(self):
+        """ Start connecting to the target TiVo, with a five second
+            timeout. connected() is called with the result.
+
+        """
+        if self.closed:
+            return None
+        self.connecting = True
+        host, port = self.target
+        conn = self.loop.create_connection(lambda: TiVoProtocol(self),
+                                           host, port)
+        task = self.loop.create_task(asyncio.wait_for(conn, 5))
+        task.add_done_callback(self.connected)
+        self.connect_task = task
+        return task
+
+    def connected(self, task):
+        self.connecting = False
+        self.connect_task = None
+        if task.cancelled():
+            return
+        err = task.exception()
+        if err:
+            self.log.info('%s', str(err) or 'Timed out')
+            self.count_connect('failed')
+            if self.reconnect:
+                self.loop.call_later(self.next_delay(), self.connect)
+            else:
+                if self.hold_timer:
+                    self.hold_timer.cancel()
+                self.drop_held()
+                self.engine.check()
+            return
+        self.tivo, protocol = task.result()
+        tune_socket(self.tivo.get_extra_info('socket'), self.keepalive,
+                    self.nodelay)
+        self.count_connect('ok')
+        self.delay = BACKOFF_MIN
+        if self.hold_timer:
+            self.hold_timer.cancel()
+            self.hold_timer = None
+        self.log.info('Connected to TiVo at %s, port %d', *self.target)
+        self.process_queue()
+
+    def disconnect(self):
+        """ Note the lost connection, and start reconnecting -- or with
+            -x, shut down this proxy.
+
+        """
+        Proxy.disconnect(self)
+        if self.reconnect:
+            self.connect()
+        else:
+            for server in self.servers():
+                server.close()
+            self.engine.check()
+
+    def hang_up(self):
+        """ As Proxy.hang_up(), by way of the event loop. """
+        tivo = self.tivo
+        if tivo:
+            self.loop.call_soon_threadsafe(tivo.close)
+
+    def listen(self):
+        """ Start serving client remote control programs, trying the next
+            ports if need be, per self.tries. Return the asyncio Server,
+            or None, and update host_port with the port used.
+
+        """
+        addr, port = self.host_port
+        tries = self.tries
+        while tries:
+            try:
+                server = self.loop.run_until_complete(
+                    self.loop.create_server(lambda: ClientProtocol(self),
+                                            addr or '0.0.0.0', port,
+                                            backlog=BACKLOG))
+                break
+            except Exception:
+                tries -= 1
+                if tries:
+                    self.log.info('Port %d already in use', port)
+                else:
+                    self.log.error('Port %d already in use', port)
+                    return None
+                port += 1
+        self.host_port = (addr, port)
+        return server
+
+    def listen_unix(self):
+        """ Start serving clients on the Unix socket self.unix. Return the
+            asyncio Server, or None.
+
+        """
+        try:
+            remove_socket(self.unix)
+            return self.loop.run_until_complete(
+                self.loop.create_unix_server(
+                    lambda: ClientProtocol(self, self.unix), self.unix,
+                    backlog=BACKLOG))
+        except Exception as err:
+            self.log.error('%s: %s', self.unix, err)
+            return None
+
+    def cleanup(self):
+        """ Close the servers and all connections. """
+        self.closed = True
+        if self.connect_task:
+            self.connect_task.cancel()
+        for l in self.servers() + [self.tivo] + list(self.listeners):
+            if l:
+                l.close()
+        if self.unix_server:
+            remove_socket(self.unix)
+
+class AsyncEngine(ThreadEngine):
+    """ Run proxies from a single thread, with one asyncio event loop for
+        all of them.
+
+    """
+    proxy_class = AsyncProxy
+
+    def __init__(self, metrics=None, tracer=None, log=None):
+        self.loop = asyncio.new_event_loop()
+        self.proxies = []
+        self.log = log or Log()
+        self.tracer = tracer
+        self.metrics = None
+        self.metrics_server = None
+        if metrics:
+            self.metrics = Metrics()
+            self.metrics_server = self.serve_metrics(metrics)
+
+    def serve(self):
+        """ Run the event loop until KeyboardInterrupt, or until no
+            proxies are left running; then clean up.
+
+        """
+        try:
+            if any(p.running() for p in self.proxies):
+                self.loop.call_later(REAP_INTERVAL, self.reap)
+                self.loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        for proxy in self.proxies:
+            proxy.cleanup()
+        if self.metrics_server:
+            self.metrics_server.close()
+        tasks = [p.connect_task for p in self.proxies if p.connect_task]
+        if tasks:
+            self.loop.run_until_complete(asyncio.wait(tasks))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    def serve_metrics(self, host_port):
+        """ Start serving metrics requests. """
+        host, port = host_port
+        try:
+            return self.loop.run_until_complete(self.loop.create_server(
+                lambda: MetricsProtocol(self), host or '0.0.0.0', port))
+        except Exception as err:
+            self.log.error('Metrics port %d: %s', port, err)
+            return None
+
+    def reap(self):
+        """ Check each proxy for dead and idle clients, every
+            REAP_INTERVAL seconds.
+
+        """
+        for proxy in self.proxies:
+            proxy.reap()
+        self.loop.call_later(REAP_INTERVAL, self.reap)
+
+    def check(self):
+        """ Stop the event loop if none of the proxies are running. """
+        if not any(p.running() for p in self.proxies):
+            self.loop.stop()
+
+ENGINES = {'thread': ThreadEngine, 'asyncio': AsyncEngine}
 
 def dump(tivos, verbose):
-    """ List TiVos found and exit. """
+    """ List TiVos found. """
     for key, data in tivos.items():
         address, port = key
         name, prop = data
@@ -376,13 +2600,92 @@ def by_name(tivos, target):
             pass
     return names.get(target)
 
+def is_address(target):
+    """ Tell whether a target is a literal IP address (with or without a
+        port), which can be connected to without looking up any TiVos.
+
+    """
+    host = target.split(':')[0]
+    if len(host.split('.')) != 4:
+        return False
+    try:
+        socket.inet_aton(host)
+    except socket.error:
+        return False
+    return True
+
+def found_all(tmode, targets):
+    """ Return a function to tell when discovery has found what's needed
+        for the target mode, or the TiVos named in targets -- or None, if
+        it should run until quiet.
+
+    """
+    if tmode == _TFIRST:
+        return lambda tivos: any(not data[0].startswith('Proxy(')
+                                 for data in tivos.values())
+    if tmode:
+        return None
+    names = [t for t, t_port in targets if not is_address(t)]
+    return lambda tivos: all(by_name(tivos, t) for t in names)
+
+def announce(zc, proxies, tivos, discover, cache=None):
+    """ Announce the proxies (those with a TCP port), first looking up
+        the TiVos (for their names and TSNs) if that hasn't been done --
+        or was done from the cache, which is then brought up to date, and
+        any TiVo that has moved is followed. Then keep following them
+        (see ZCBroadcast.track()). Run in the background, so the proxies
+        are serving meanwhile.
+
+    """
+    if discover:
+        found = zc.find_tivos(True)
+        if cache:
+            cache.save(found)
+        retarget(proxies, tivos, found)
+        tivos = dict(tivos)
+        tivos.update(found)
+    registrations = [(proxy, zc.announce(proxy.target, proxy.host_port,
+                                         tivos))
+                     for proxy in proxies if proxy.tcp]
+    for proxy, registration in registrations:
+        if not registration.wait():
+            proxy.log.error('Zeroconf announcement failed: %s',
+                            registration.error)
+    zc.track(proxies, tivos)
+
+def retarget(proxies, tivos, found):
+    """ Point any proxy whose TiVo (as it was listed in 'tivos') is now
+        found at a different address, by its TSN, to the new address --
+        or, if it's now found to be proxied already (by name or address,
+        as in find_tivos()), to that proxy.
+
+    """
+    moved = {}
+    proxied = {}
+    for address, (name, prop) in found.items():
+        if name.startswith('Proxy('):
+            proxied[name[6:-1]] = address
+        elif prop:
+            moved[prop.get('TSN')] = address
+    for proxy in proxies:
+        name, prop = tivos.get(proxy.target, (None, None))
+        if name is None:
+            continue
+        address = proxied.get(name) or proxied.get(proxy.target[0])
+        if address:
+            proxy.defer(address)
+            continue
+        address = moved.get(prop and prop.get('TSN'))
+        if address:
+            proxy.retarget(address)
+
 def get_target(tivos, target, tmode, verbose):
     """ Find the address/port pair (or don't), depending on the target
         mode selected by the options.
 
     """
     if tmode == _TLIST:
-        return dump(tivos, verbose)
+        return None     # Already listed as found; see main()
     elif tmode == _TSELECT:
         return choose(tivos)
     elif tmode == _TFIRST:
@@ -403,22 +2706,112 @@ def get_target(tivos, target, tmode, verbose):
         t_port = DEFAULT_HOST[1]
     return (target, t_port)
 
+def read_config(filename):
+    """ Read a list of TiVos to proxy, with optional ports, from a file.
+        Return a list of (target, port) pairs, with port None if not set.
+
+    """
+    targets = []
+    try:
+        for line in open(filename):
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            port = None
+            if len(words) > 1:
+                port = int(words[1])
+            targets.append((words[0], port))
+    except (IOError, ValueError) as msg:
+        sys.stderr.write('%s: %s\n' % (filename, str(msg)))
+        sys.exit(1)
+    return targets
+
+def parse_classes(value):
+    """ Parse a list of per-command-class settings in seconds, like
+        'IRCODE:0.05,SETCH:0.2', into a dict.
+
+    """
+    classes = {}
+    try:
+        for item in value.split(','):
+            kind, secs = item.split(':')
+            classes[kind.strip().upper().encode('ascii')] = float(secs)
+    except ValueError:
+        sys.stderr.write('Bad command class list: %s\n' % value)
+        sys.exit(1)
+    return classes
+
+def parse_address(value):
+    """ Parse a port, or address:port, into a tuple. """
+    try:
+        if ':' in value:
+            host, port = value.rsplit(':', 1)
+            return (host, int(port))
+        return ('', int(value))
+    except ValueError:
+        sys.stderr.write('Bad address: %s\n' % value)
+        sys.exit(1)
+
+def parse_priorities(value):
+    """ Parse a list of host:turns pairs into a dict. """
+    priorities = {}
+    try:
+        for item in value.split(','):
+            host, turns = item.rsplit(':', 1)
+            priorities[host.strip()] = max(1, int(turns))
+    except ValueError:
+        sys.stderr.write('Bad priority list: %s\n' % value)
+        sys.exit(1)
+    return priorities
+
+def get_targets(tivos, targets, tmode, verbose):
+    """ Find the address/port pairs of all the TiVos to proxy, each
+        with the port to serve it on, if one was given.
+
+    """
+    if tmode == _TALL:
+        found = [(address, None) for address, data in tivos.items()
+                 if not data[0].startswith('Proxy(')]
+        if not found:
+            sys.stderr.write('No TiVos available\n')
+        return found
+    if tmode:
+        target = get_target(tivos, None, tmode, verbose)
+        return [(target, None)] if target else []
+    return [(get_target(tivos, target, None, verbose), port)
+            for target, port in targets]
+
 def parse_cmdline(params):
-    """ Parse the command-line options, and return tuples for host and
-        target addresses, plus the verbose flag.
+    """ Parse the command-line options, and return the list of targets
+        (each with a port, or None), the host address tuple, the verbose
+        flag, and the other settings.
 
     """
     host, port = DEFAULT_HOST
-    use_zc = have_zc
+    use_zc = True
     verbose = False
     tmode = None
     recon = True
+    config = []
+    settings = {'engine': 'thread'}
 
     try:
-        opts, targets = getopt.getopt(params, 'a:p:lifzvxh', ['address=',
-                                      'port=', 'list', 'interactive',
-                                      'first', 'nozeroconf',
-                                      'verbose', 'exitdc', 'help'])
+        opts, targets = getopt.getopt(params, 'a:p:u:lifAc:zvxe:h', [
+                                      'address=', 'port=', 'unix=', 'notcp',
+                                      'list', 'interactive',
+                                      'first', 'all', 'config=', 'nozeroconf',
+                                      'quiet-period=', 'cache=', 'cache-ttl=',
+                                      'verbose', 'exitdc', 'engine=',
+                                      'pacing=', 'pace=', 'queue-depth=',
+                                      'priority=', 'coalesce=',
+                                      'output-limit=', 'overflow=', 'batch=',
+                                      'keepalive=', 'nagle', 'probe=',
+                                      'idle=', 'max-clients=',
+                                      'accept-policy=',
+                                      'backoff=', 'hold=', 'max-age=',
+                                      'metrics=', 'trace=', 'trace-rate=',
+                                      'log-level=', 'log-json', 'log-rate=',
+                                      'help'])
     except getopt.GetoptError as msg:
         sys.stderr.write('%s\n' % str(msg))
         sys.exit(1)
@@ -428,55 +2821,198 @@ def parse_cmdline(params):
             host = value
         elif opt in ('-p', '--port'):
             port = int(value)
+        elif opt in ('-u', '--unix'):
+            settings['unix'] = value
+        elif opt == '--notcp':
+            settings['tcp'] = False
         elif opt in ('-l', '--list'):
             tmode = _TLIST
         elif opt in ('-i', '--interactive'):
             tmode = _TSELECT
         elif opt in ('-f', '--first'):
             tmode = _TFIRST
+        elif opt in ('-A', '--all'):
+            tmode = _TALL
+        elif opt in ('-c', '--config'):
+            config.extend(read_config(value))
         elif opt in ('-z', '--nozeroconf'):
             use_zc = False
+        elif opt == '--quiet-period':
+            settings['quiet_period'] = float(value)
+        elif opt == '--cache':
+            settings['cache'] = value
+        elif opt == '--cache-ttl':
+            settings['cache_ttl'] = float(value)
         elif opt in ('-v', '--verbose'):
             verbose = True
+            settings['log_level'] = 'debug'
+        elif opt == '--log-level':
+            if value not in LOG_LEVELS:
+                sys.stderr.write('Unknown log level: %s\n' % value)
+                sys.exit(1)
+            settings['log_level'] = value
+        elif opt == '--log-json':
+            settings['log_json'] = True
+        elif opt == '--log-rate':
+            settings['log_rate'] = float(value)
         elif opt in ('-x', '--exitdc'):
             recon = False
+        elif opt in ('-e', '--engine'):
+            settings['engine'] = value
+        elif opt == '--pacing':
+            if value not in ('fixed', 'adaptive'):
+                sys.stderr.write('Unknown pacing: %s\n' % value)
+                sys.exit(1)
+            settings['adaptive'] = (value == 'adaptive')
+        elif opt == '--pace':
+            settings['ceilings'] = parse_classes(value)
+        elif opt == '--queue-depth':
+            settings['depth'] = int(value)
+        elif opt == '--priority':
+            settings['priorities'] = parse_priorities(value)
+        elif opt == '--coalesce':
+            settings['coalesce'] = float(value)
+        elif opt == '--output-limit':
+            settings['limit'] = max(1, int(value))
+        elif opt == '--overflow':
+            if value not in OVERFLOW:
+                sys.stderr.write('Unknown overflow policy: %s\n' % value)
+                sys.exit(1)
+            settings['overflow'] = value
+        elif opt == '--batch':
+            settings['batch'] = float(value)
+        elif opt == '--keepalive':
+            settings['keepalive'] = float(value)
+        elif opt == '--nagle':
+            settings['nodelay'] = False
+        elif opt == '--probe':
+            settings['probe'] = float(value)
+        elif opt == '--idle':
+            settings['idle'] = float(value)
+        elif opt == '--max-clients':
+            settings['max_clients'] = int(value)
+        elif opt == '--accept-policy':
+            if value not in ACCEPT_POLICIES:
+                sys.stderr.write('Unknown accept policy: %s\n' % value)
+                sys.exit(1)
+            settings['accept_policy'] = value
+        elif opt == '--backoff':
+            settings['backoff'] = max(BACKOFF_MIN, float(value))
+        elif opt == '--hold':
+            settings['hold'] = float(value)
+        elif opt == '--max-age':
+            settings['max_ages'] = parse_classes(value)
+        elif opt == '--metrics':
+            settings['metrics'] = parse_address(value)
+        elif opt == '--trace':
+            settings['trace'] = value
+        elif opt == '--trace-rate':
+            settings['trace_rate'] = float(value)
         elif opt in ('-h', '--help'):
             print(__doc__)
             sys.exit()
 
-    if tmode and not use_zc:
-        sys.stderr.write('-i, -l and -f require Zeroconf\n')
+    if tmode and not (use_zc and load_zeroconf()):
+        sys.stderr.write('-i, -l, -f and -A require Zeroconf\n')
         sys.exit(1)
 
+    if not settings.get('tcp', True):
+        if 'unix' not in settings:
+            sys.stderr.write('--notcp requires --unix\n')
+            sys.exit(1)
+
+    targets = [(target, None) for target in targets] + config
     if not tmode and not targets:
         sys.stderr.write('Must specify an address\n')
         sys.exit(1)
 
-    return targets, (host, port), use_zc, verbose, tmode, recon
+    if settings['engine'] not in ENGINES:
+        sys.stderr.write('Unknown engine: %s\n' % settings['engine'])
+        sys.exit(1)
+
+    if settings['engine'] == 'asyncio' and not asyncio:
+        sys.stderr.write('The asyncio engine requires Python 3\n')
+        sys.exit(1)
+
+    return targets, (host, port), use_zc, verbose, tmode, recon, settings
 
 def main(argv):
     tivos = {}
 
-    targets, host_port, use_zc, verbose, tmode, recon = parse_cmdline(argv)
-
-    if use_zc:
+    (targets, host_port, use_zc, verbose, tmode, recon,
+     settings) = parse_cmdline(argv)
+    engine_class = ENGINES[settings.pop('engine')]
+    trace = settings.pop('trace', None)
+    trace_rate = settings.pop('trace_rate', 1)
+    log_settings = (settings.pop('log_level', 'error'),
+                    settings.pop('log_json', False),
+                    settings.pop('log_rate', 0))
+    quiet = settings.pop('quiet_period', QUIET_PERIOD)
+    cache = None
+    cache_file = settings.pop('cache', CACHE_FILE)
+    cache_ttl = settings.pop('cache_ttl', CACHE_TTL)
+    if cache_ttl:
+        cache = Cache(cache_file, cache_ttl)
+
+    # Look up TiVos only when needed to choose or find one by name or TSN;
+    # addresses can be used at once, and so can TiVos found in the cache
+
+    discover = tmode or not all(is_address(t) for t, t_port in targets)
+    looked_up = False
+    if use_zc and load_zeroconf():
         try:
             zc = ZCBroadcast()
         except:
             use_zc = False
-        if use_zc:
-            tivos = zc.find_tivos(tmode == _TLIST)
-
-    try:
-        target = targets[0]
-    except:
-        target = None
-    target = get_target(tivos, target, tmode, verbose)
-
-    if target:
-        if use_zc:
-            zc.announce(target, host_port, tivos)
-        Proxy(target, host_port, verbose, recon)
+    else:
+        use_zc = False
+    if use_zc and discover:
+        done = found_all(tmode, targets)
+        if cache and done and tmode != _TFIRST:
+            tivos = cache.load()
+        if not (done and done(tivos)):
+            found = None
+            if tmode == _TLIST:
+                found = lambda address, data: dump({address: data}, verbose)
+            tivos = zc.find_tivos(tmode == _TLIST, done, found, quiet)
+            looked_up = True
+            if cache:
+                cache.save(tivos)
+
+    targets = get_targets(tivos, targets, tmode, verbose)
+
+    if targets:
+        tracer = None
+        if trace:
+            try:
+                tracer = Tracer(trace, trace_rate)
+            except IOError as err:
+                sys.stderr.write('%s\n' % str(err))
+                sys.exit(1)
+        log = Log(*log_settings)
+        engine = engine_class(settings.pop('metrics', None), tracer, log)
+        host, port = host_port
+        unix = settings.pop('unix', None)
+        proxies = []
+        for i, (target, t_port) in enumerate(targets):
+            if unix and len(targets) > 1:
+                settings['unix'] = '%s.%d' % (unix, i + 1)
+            else:
+                settings['unix'] = unix
+            proxy = engine.add(target, (host, t_port or port), recon,
+                               tries=(1 if t_port else None), **settings)
+            if not proxy:
+                continue
+            if not t_port:
+                port = proxy.host_port[1] + 1
+            proxies.append(proxy)
+        if use_zc and proxies:
+            _thread.start_new_thread(announce, (zc, proxies, tivos,
+                                                not looked_up, cache))
+        engine.serve()
+        if tracer:
+            tracer.close()
+        log.close()
 
     if use_zc:
         zc.shutdown()
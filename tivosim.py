@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+# TiVo Simulator for rproxy
+# Copyright 2014-2020 William McBrine
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+""" TiVo Simulator
+
+    A stand-in for the "Crestron" interface (port 31339) of a TiVo, for
+    testing and benchmarking rproxy without a real TiVo. Like the TiVo,
+    it serves one connection at a time, sends the current channel on
+    connecting, and answers SETCH, FORCECH, IRCODE CHANNELUP/DOWN and
+    TELEPORT LIVETV with status messages. Other commands are accepted
+    silently.
+
+    Command-line options:
+
+    -a, --address      Specify the address to serve from. The default is
+                       '127.0.0.1'.
+
+    -p, --port         Specify the port to serve from. The default is
+                       31339.
+
+    -l, --latency      How long to take over each command before
+                       responding, in seconds. Commands are handled one
+                       at a time, as on the TiVo. The default is 0.
+
+    -s, --status       Send an unsolicited status message (as when the
+                       channel is changed with the TiVo's own remote)
+                       this often, in seconds. The default is never.
+
+    -d, --drop         Drop the connection after this many commands, as
+                       if the TiVo rebooted. The default is never.
+
+    -w, --down         After dropping the connection, refuse new ones
+                       for this many seconds. The default is 5.
+
+    -v, --verbose      Echo commands and responses to the console.
+
+    -h, --help         Print help and exit.
+
+"""
+
+__author__ = 'William McBrine <wmcbrine@gmail.com>'
+__version__ = '0.8'
+__license__ = 'GPL'
+
+import getopt
+import socket
+import sys
+import threading
+import time
+
+DEFAULT_HOST = ('127.0.0.1', 31339)
+
+class TiVoSim:
+    """ Serve the TiVo remote protocol. The time each status message was
+        last sent is kept in self.sent, for benchmarking.
+
+    """
+    def __init__(self, host_port=DEFAULT_HOST, latency=0, status=0,
+                 drop=0, down=5, verbose=False):
+        self.host_port = host_port
+        self.latency = latency
+        self.status = status
+        self.drop = drop
+        self.down = down
+        self.verbose = verbose
+        self.channel = 1
+        self.conn = None
+        self.lock = threading.Lock()
+        self.sent = {}
+        self.count = 0
+        self.server = self.listen()
+
+    def listen(self):
+        server = socket.socket()
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(self.host_port)
+        server.listen(5)
+        self.host_port = server.getsockname()
+        return server
+
+    def start(self):
+        """ Serve in the background. """
+        for func in (self.serve, self.emit_status):
+            thread = threading.Thread(target=func)
+            thread.daemon = True
+            thread.start()
+
+    def serve(self):
+        server = self.server
+        while True:
+            try:
+                conn, address = server.accept()
+            except socket.error:
+                return  # closed by reboot()
+            if self.verbose:
+                sys.stderr.write('Connection from %s, port %d\n' % address)
+            with self.lock:
+                if self.conn:
+                    # Like the TiVo, allow only one connection
+                    self.conn.close()
+                self.conn = conn
+            self.send_status()
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        """ Read commands, and respond to each in turn. """
+        buf = b''
+        while True:
+            try:
+                data = conn.recv(1024)
+            except socket.error:
+                break
+            if not data:
+                break
+            lines = (buf + data).split(b'\r')
+            buf = lines.pop()
+            for line in lines:
+                line = line.strip()
+                if line:
+                    self.command(line)
+            if self.drop and self.count >= self.drop:
+                self.reboot(conn)
+                break
+        with self.lock:
+            if self.conn is conn:
+                self.conn = None
+        conn.close()
+
+    def command(self, line):
+        if self.verbose:
+            sys.stderr.write('%s\n' % line)
+        self.count += 1
+        if self.latency:
+            time.sleep(self.latency)
+        words = line.decode('ascii', 'replace').upper().split()
+        cmd = words[0]
+        arg = words[1] if len(words) > 1 else ''
+        if cmd in ('SETCH', 'FORCECH'):
+            try:
+                self.channel = int(arg)
+            except ValueError:
+                self.send(b'CH_FAILED MALFORMED_CHANNEL\r')
+                return
+            self.send_status()
+        elif cmd == 'IRCODE' and arg in ('CHANNELUP', 'CHANNELDOWN'):
+            self.channel += 1 if arg == 'CHANNELUP' else -1
+            self.channel = max(1, self.channel)
+            self.send_status()
+        elif cmd == 'TELEPORT' and arg == 'LIVETV':
+            self.send(b'LIVETV_READY\r')
+
+    def send_status(self):
+        self.send(('CH_STATUS %04d LOCAL\r' % self.channel).encode('ascii'))
+
+    def send(self, status):
+        with self.lock:
+            if not self.conn:
+                return
+            if self.verbose:
+                sys.stderr.write('%s\n' % status.strip())
+            self.sent[status] = time.time()
+            try:
+                self.conn.sendall(status)
+            except socket.error:
+                pass
+
+    def emit_status(self):
+        while self.status:
+            time.sleep(self.status)
+            self.send_status()
+
+    def reboot(self, conn):
+        """ Drop the connection, and refuse others for a while. """
+        if self.verbose:
+            sys.stderr.write('Dropping connection\n')
+        self.count = 0
+        with self.lock:
+            self.conn = None
+        conn.close()
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.server.close()
+        time.sleep(self.down)
+        self.server = self.listen()
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+def parse_cmdline(params):
+    host, port = DEFAULT_HOST
+    settings = {}
+
+    try:
+        opts, args = getopt.getopt(params, 'a:p:l:s:d:w:vh', ['address=',
+                                   'port=', 'latency=', 'status=', 'drop=',
+                                   'down=', 'verbose', 'help'])
+    except getopt.GetoptError as msg:
+        sys.stderr.write('%s\n' % str(msg))
+        sys.exit(1)
+
+    for opt, value in opts:
+        if opt in ('-a', '--address'):
+            host = value
+        elif opt in ('-p', '--port'):
+            port = int(value)
+        elif opt in ('-l', '--latency'):
+            settings['latency'] = float(value)
+        elif opt in ('-s', '--status'):
+            settings['status'] = float(value)
+        elif opt in ('-d', '--drop'):
+            settings['drop'] = int(value)
+        elif opt in ('-w', '--down'):
+            settings['down'] = float(value)
+        elif opt in ('-v', '--verbose'):
+            settings['verbose'] = True
+        elif opt in ('-h', '--help'):
+            print(__doc__)
+            sys.exit()
+
+    return (host, port), settings
+
+def main(argv):
+    host_port, settings = parse_cmdline(argv)
+    sim = TiVoSim(host_port, **settings)
+    sys.stderr.write('Simulating a TiVo at %s, port %d\n' % sim.host_port)
+    sim.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -37,7 +37,8 @@ from functools import reduce
 
 pythree = (sys.version_info[0] == 3)
 
-__all__ = ["Zeroconf", "ServiceInfo", "ServiceBrowser", "pythree"]
+__all__ = ["Zeroconf", "ServiceInfo", "ServiceBrowser", "Registration",
+           "pythree"]
 
 # hook for threads
 
@@ -963,6 +964,37 @@ class ServiceBrowser(threading.Thread):
                 event(self.zc)
 
 
+class Registration(threading.Thread):
+    """Registers a service in the background, returned by
+    Zeroconf.registerServiceAsync().  The probes and announcements take
+    over a second, which the caller need not wait for.  wait() returns
+    True once the service is registered, or False if that failed, with
+    the exception in self.error."""
+
+    def __init__(self, zc, info, ttl):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.zc = zc
+        self.info = info
+        self.ttl = ttl
+        self.error = None
+        self.finished = threading.Event()
+        self.start()
+
+    def run(self):
+        try:
+            self.zc.registerService(self.info, self.ttl)
+        except Exception as e:
+            self.error = e
+        self.finished.set()
+
+    def wait(self, timeout=None):
+        """Waits (up to timeout seconds, if given) for the registration
+        to finish, and returns True if it succeeded."""
+        self.finished.wait(timeout)
+        return self.finished.is_set() and self.error is None
+
+
 class ServiceInfo(object):
     """Service information"""
 
@@ -1322,6 +1354,11 @@ class Zeroconf(object):
             i += 1
             nextTime += _REGISTER_TIME
 
+    def registerServiceAsync(self, info, ttl=_DNS_TTL):
+        """Like registerService(), but returns at once, with a
+        Registration to follow its progress."""
+        return Registration(self, info, ttl)
+
     def unregisterService(self, info):
         """Unregister a service."""
         try: